@@ -20,29 +20,208 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import bisect
+import itertools
+import logging
 import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from burnet.exception import InvalidOperation, NotFoundError
+
+
+# What is kept of a task
+TASK_ATTRS = ('id', 'target_uri', 'message', 'status', 'progress',
+              'results')
+
 
 class NotProperOps(Exception):
     pass
 
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskRegistry(object):
+    """
+    The state of the tasks, served from memory.  Changes are written to the
+    object store every FLUSH_SECS, and at once when a task ends.  Ended
+    tasks are dropped RETENTION_SECS later, or sooner when more than
+    MAX_ENDED of them are kept.
+    """
+    FLUSH_SECS = 5
+    RETENTION_SECS = 3600
+    MAX_ENDED = 1000
+    # Long-polls hold a server thread, so keep them few and short
+    MAX_WAIT = 30
+    MAX_WAITERS = 4
+    log = logging.getLogger('TaskRegistry')
+
+    def __init__(self, objstore):
+        self.objstore = objstore
+        self._tasks = {}
+        self._dirty = set()
+        # id -> time the task ended, oldest first
+        self._ended = OrderedDict()
+        self._lock = threading.Lock()
+        # Notified when a task ends
+        self._changed = threading.Condition(self._lock)
+        self._waiters = 0
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+    def update(self, task):
+        obj = dict((attr, getattr(task, attr)) for attr in TASK_ATTRS)
+        ended = obj['status'] != 'running'
+        with self._changed:
+            self._tasks[task.id] = obj
+            self._dirty.add(task.id)
+            if ended:
+                self._ended[task.id] = time.time()
+                self._changed.notifyAll()
+        self._ensure_flusher()
+        if ended:
+            self.flush()
+
+    def lookup(self, id, wait=0):
+        """
+        Return the state of a task.  While it is running, wait up to 'wait'
+        seconds (at most MAX_WAIT) for it to end.  Only MAX_WAITERS requests
+        wait at the same time, the others return at once.
+        """
+        end = time.time() + min(wait, self.MAX_WAIT)
+        with self._changed:
+            task = self._get(id)
+            if (wait <= 0 or task['status'] != 'running' or
+                    self._waiters >= self.MAX_WAITERS):
+                return dict(task)
+            self._waiters += 1
+            try:
+                while task['status'] == 'running' and time.time() < end:
+                    self._changed.wait(end - time.time())
+                    task = self._get(id)
+            finally:
+                self._waiters -= 1
+            return dict(task)
+
+    def _get(self, id):
+        try:
+            return self._tasks[str(id)]
+        except KeyError:
+            raise NotFoundError(id)
+
+    def get_list(self):
+        with self._lock:
+            return self._tasks.keys()
+
+    def flush(self):
+        # Keep the writes of concurrent flushes in order
+        with self._flush_lock:
+            with self._lock:
+                items = [(id, self._tasks[id]) for id in self._dirty
+                         if id in self._tasks]
+                self._dirty.clear()
+            if items:
+                with self.objstore as session:
+                    session.store_many('task', items)
+
+    def expire(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            for id, ended in self._ended.items():
+                if (now - ended < self.RETENTION_SECS and
+                        len(self._ended) <= self.MAX_ENDED):
+                    break
+                del self._ended[id]
+                del self._tasks[id]
+                self._dirty.discard(id)
+                expired.append(id)
+        if not expired:
+            return
+        with self._flush_lock:
+            with self.objstore as session:
+                with session.transaction():
+                    for id in expired:
+                        try:
+                            session.delete('task', id)
+                        except NotFoundError:
+                            pass
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher,
+                                                 name='TaskFlusher')
+                self._flusher.setDaemon(True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.FLUSH_SECS)
+            try:
+                self.flush()
+                self.expire()
+            except Exception, e:
+                self.log.error("Unable to save tasks: %s" % e)
+
+
 class AsyncTask(object):
-    def __init__(self, id, target_uri, fn, objstore, opaque=None):
+    """
+    Run fn(cb, opaque) in the background, where fn reports its progress
+    with cb(message) and its result with cb(message, success).  It may
+    also pass a progress dict with the 'done' and 'total' units of work,
+    and the 'bytes_done' and 'bytes_total' bytes, as in
+    cb(message, progress={'done': 1, 'total': 4}).  Tasks working on several
+    objects may pass the list of their results as results=[...].  Tasks run
+    on a TaskScheduler when one is given, on their own thread otherwise.
+    Their state goes to the TaskRegistry when one is given, straight to the
+    object store otherwise.
+    """
+    def __init__(self, id, target_uri, fn, objstore, opaque=None,
+                 scheduler=None, task_type=None, priority=0, registry=None):
         if objstore == None:
             raise NotProperOps("Initiate datastore in the model object")
         self.id = str(id)
         self.target_uri = target_uri
         self.fn = fn
+        self.opaque = opaque
         self.objstore = objstore
+        self.registry = registry
+        self.task_type = task_type
+        self.priority = priority
         self.status = 'running'
+        self.progress = None
+        self.results = None
+        self.started = None
+        self.cancelled = False
 
         self.message = 'OK'
         self._save_helper()
-        self.thread = threading.Thread(target=self._run_helper,
-                                       args=(opaque, self._status_cb))
+        if scheduler is not None:
+            scheduler.submit(self)
+            return
+        self.thread = threading.Thread(target=self.run)
         self.thread.setDaemon(True)
         self.thread.start()
 
-    def _status_cb(self, message, success=None):
+    def _status_cb(self, message, success=None, progress=None, results=None):
+        # Unwind the task function at its next report
+        if self.cancelled:
+            raise TaskCancelled()
+
+        if progress is not None:
+            self._set_progress(progress)
+        if results is not None:
+            self.results = list(results)
+
         if success == None:
            self.message = message
            self._save_helper()
@@ -55,15 +234,165 @@ class AsyncTask(object):
         self.message = message
         self._save_helper()
 
+    def _set_progress(self, progress):
+        progress = dict((key, progress.get(key)) for key in
+                        ('done', 'total', 'bytes_done', 'bytes_total'))
+        # Bytes tell best how much is left
+        done, total = progress['bytes_done'], progress['bytes_total']
+        if not total:
+            done, total = progress['done'], progress['total']
+        progress['percent'] = progress['eta'] = None
+        if total:
+            progress['percent'] = min(100, 100 * done / total)
+            if done and self.started is not None:
+                elapsed = time.time() - self.started
+                progress['eta'] = int(elapsed * (total - done) / done)
+        self.progress = progress
+
     def _save_helper(self):
-        obj = {}
-        for attr in ('id', 'target_uri', 'message', 'status'):
-            obj[attr] = getattr(self, attr)
+        if self.registry is not None:
+            self.registry.update(self)
+            return
+        obj = dict((attr, getattr(self, attr)) for attr in TASK_ATTRS)
         with self.objstore as session:
             session.store('task', self.id, obj)
 
+    def cancel(self):
+        """
+        Mark the task as cancelled.  A running task stops when it next
+        reports its progress.
+        """
+        self.cancelled = True
+
+    def _cancelled(self):
+        self.status = 'cancelled'
+        self.message = 'Cancelled'
+        self._save_helper()
+
+    def run(self):
+        if self.cancelled:
+            self._cancelled()
+            return
+        self.started = time.time()
+        self._run_helper(self.opaque, self._status_cb)
+
     def _run_helper(self, opaque, cb):
         try:
             self.fn(cb, opaque)
+        except TaskCancelled:
+            self._cancelled()
         except Exception, e:
-            cb("Unexpected exception: %s" % str(e), False)
+            if self.cancelled:
+                self._cancelled()
+            else:
+                cb("Unexpected exception: %s" % str(e), False)
+
+
+class TaskScheduler(object):
+    """
+    Run AsyncTasks on a bounded pool of worker threads, highest priority
+    first and then in submission order.  At most limits[task_type] tasks of
+    a type run at the same time, and tasks sharing a target_uri run one
+    after another.
+    """
+    WORKERS = 8
+    # Number of started tasks the average wait is computed on
+    WAIT_SAMPLES = 100
+
+    def __init__(self, workers=None, limits=None):
+        self.workers = workers or self.WORKERS
+        self.limits = limits or {}
+        # (-priority, sequence, submission time, task), sorted
+        self._queue = []
+        self._tasks = {}
+        self._running = {}
+        self._targets = set()
+        self._waits = []
+        self._seq = itertools.count()
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def submit(self, task):
+        with self._cond:
+            bisect.insort(self._queue, (-task.priority, self._seq.next(),
+                                        time.time(), task))
+            self._tasks[task.id] = task
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker,
+                                     name='TaskWorker-%i' % len(self._threads))
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+            self._cond.notifyAll()
+
+    def cancel(self, id):
+        """
+        Cancel a queued or running task.
+        """
+        with self._cond:
+            try:
+                task = self._tasks[str(id)]
+            except KeyError:
+                raise InvalidOperation(
+                    "Task %s is not running" % id)
+            task.cancel()
+            for i, item in enumerate(self._queue):
+                if item[3] is task:
+                    # A queued task ends here
+                    del self._queue[i]
+                    del self._tasks[task.id]
+                    break
+            else:
+                return
+        task.run()
+
+    def _runnable(self, task):
+        limit = self.limits.get(task.task_type)
+        if limit is not None and self._running.get(task.task_type, 0) >= limit:
+            return False
+        return not task.target_uri or task.target_uri not in self._targets
+
+    def _next(self):
+        while True:
+            for i, item in enumerate(self._queue):
+                task = item[3]
+                if self._runnable(task):
+                    del self._queue[i]
+                    self._waits.append(time.time() - item[2])
+                    del self._waits[:-self.WAIT_SAMPLES]
+                    return task
+            self._cond.wait()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next()
+                self._running[task.task_type] = \
+                    self._running.get(task.task_type, 0) + 1
+                if task.target_uri:
+                    self._targets.add(task.target_uri)
+            try:
+                task.run()
+            finally:
+                with self._cond:
+                    self._running[task.task_type] -= 1
+                    self._targets.discard(task.target_uri)
+                    # A newer task may have been submitted with the same id
+                    if self._tasks.get(task.id) is task:
+                        del self._tasks[task.id]
+                    self._cond.notifyAll()
+
+    def stats(self):
+        """
+        Return the queue depth, the number of running tasks and how long the
+        tasks wait before they start, in seconds.
+        """
+        now = time.time()
+        with self._cond:
+            waits = self._waits
+            return {'workers': self.workers,
+                    'queued': len(self._queue),
+                    'running': sum(self._running.values()),
+                    'oldest_wait': max([now - item[2] for item in self._queue]
+                                       or [0]),
+                    'average_wait': sum(waits) / len(waits) if waits else 0}
@@ -22,10 +22,49 @@
 
 import cherrypy
 import json
+import threading
 from functools import wraps
 
 import burnet.model
 import burnet.template
+from burnet.guard import get_stale_age, note_stale_age, reset_stale_age
+from burnet.threadpool import Job, ThreadPool
+
+
+# Resource lookups of a Collection are spread over this many threads when
+# the model cannot provide all Resources in one batched call
+LOOKUP_WORKERS = 8
+_lookup_pool = None
+_lookup_pool_lock = threading.Lock()
+
+
+def set_lookup_workers(size):
+    """
+    Configure the bounded pool used for Collection lookups.  A size of 1 or
+    less makes lookups run sequentially on the request thread.
+    """
+    global LOOKUP_WORKERS, _lookup_pool
+    with _lookup_pool_lock:
+        LOOKUP_WORKERS = size
+        _lookup_pool = None
+
+
+def get_lookup_pool():
+    global _lookup_pool
+    if LOOKUP_WORKERS <= 1:
+        return None
+    with _lookup_pool_lock:
+        if _lookup_pool is None:
+            _lookup_pool = ThreadPool(LOOKUP_WORKERS, 'CollectionLookup')
+        return _lookup_pool
+
+
+def _pooled_lookup(res):
+    # Runs on a pool worker: hand the stale age of the lookup back to the
+    # request thread through the job value
+    reset_stale_age()
+    res.lookup()
+    return get_stale_age()
 
 
 def get_class_name(cls):
@@ -77,19 +116,61 @@ def parse_request():
                                       " 'application/json'")
 
 
+def parse_collection_query(params):
+    """
+    Split the query string of a Collection GET request into paging, field
+    projection and filters:
+        ?limit=<n>&offset=<n>&fields=<field>,<field>&<field>=<value>
+    A filter given more than once matches any of its values.
+    """
+    query = {'offset': 0, 'limit': None, 'fields': None, 'filters': {}}
+    for key, value in params.iteritems():
+        if key in ('limit', 'offset'):
+            try:
+                query[key] = int(value)
+            except (TypeError, ValueError):
+                query[key] = -1
+            if query[key] < 0:
+                raise cherrypy.HTTPError(400, "Invalid parameter: '%s'" % key)
+        elif key == 'fields':
+            if isinstance(value, list):
+                value = ','.join(value)
+            query['fields'] = [f for f in value.split(',') if f]
+        else:
+            if not isinstance(value, list):
+                value = [value]
+            query['filters'][key] = value
+    return query
+
+
+def set_stale_headers():
+    """
+    Mark the response as stale when the model answered with cached data
+    because libvirt could not be reached in time.
+    """
+    age = get_stale_age()
+    if age is not None:
+        cherrypy.response.headers['Age'] = str(int(age))
+        cherrypy.response.headers['Warning'] = '110 burnet "Response is Stale"'
+
+
 def action(f):
     @wraps(f)
     @cherrypy.expose
     def wrapper(*args, **kwargs):
         validate_method(('POST'))
         try:
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
+        except burnet.model.NotFoundError:
+            raise cherrypy.HTTPError(404)
         except burnet.model.MissingParameter, param:
             raise cherrypy.HTTPError(400, "Missing parameter: '%s'" % param)
         except burnet.model.InvalidParameter, param:
             raise cherrypy.HTTPError(400, "Invalid parameter: '%s'" % param)
         except burnet.model.InvalidOperation, msg:
             raise cherrypy.HTTPError(400, "Invalid operation: '%s'" % msg)
+        except burnet.model.ServiceUnavailable, msg:
+            raise cherrypy.HTTPError(503, "Service Unavailable: '%s'" % msg)
         except burnet.model.OperationFailed, msg:
             raise cherrypy.HTTPError(500, "Operation Failed: '%s'" % msg)
     return wrapper
@@ -134,17 +215,26 @@ class Resource(object):
 
     @cherrypy.expose
     def index(self):
-        method = validate_method(('GET', 'DELETE'))
-        if method == 'GET':
+        method = validate_method(('GET', 'HEAD', 'DELETE'))
+        if method in ('GET', 'HEAD'):
+            reset_stale_age()
             try:
-                return self.get()
+                ret = self.get()
             except burnet.model.NotFoundError:
                 raise cherrypy.HTTPError(404)
+            except burnet.model.ServiceUnavailable, msg:
+                raise cherrypy.HTTPError(503, "Service Unavailable: '%s'" % msg)
+            set_stale_headers()
+            return ret
         elif method == 'DELETE':
             try:
                 return self.delete()
             except burnet.model.NotFoundError:
                 raise cherrypy.HTTPError(404)
+            except burnet.model.InvalidOperation, msg:
+                raise cherrypy.HTTPError(400, "Invalid operation: '%s'" % msg)
+            except burnet.model.ServiceUnavailable, msg:
+                raise cherrypy.HTTPError(503, "Service Unavailable: '%s'" % msg)
 
     def get(self):
         self.lookup()
@@ -175,6 +265,19 @@ class Collection(object):
       needs additional information to identify this Collection.
 
     - Implement the base operations of 'create' and 'get_list' in the model.
+
+    - Optionally implement 'get_list_with_info' in the model.  It returns a
+      list of (ident, info) pairs where info is what 'lookup' would return for
+      that Resource.  When present it is preferred over 'get_list' so the
+      model can collect all Resources in one batched pass.  It receives a
+      'fields' keyword argument with the Resource fields the request needs
+      (None for all of them).  The other fields may be skipped when they are
+      expensive to compute, and then set to None.
+
+    A GET request may page, filter and project the Collection with
+    ?limit=, ?offset=, ?<field>=<value> and ?fields=<field>,...  Filtering on
+    'name' and paging without other filters are applied to the identifiers
+    before any lookup.
     """
     def __init__(self, model):
         self.model = model
@@ -183,11 +286,13 @@ class Collection(object):
         self.model_args = []
 
     def create(self, *args):
+        return self._create(parse_request())
+
+    def _create(self, params):
         try:
             create = getattr(self.model, model_fn(self, 'create'))
         except AttributeError:
             raise cherrypy.HTTPError(405)
-        params = parse_request()
         args = self.model_args + [params]
         name = create(*args)
         cherrypy.response.status = 201
@@ -195,19 +300,96 @@ class Collection(object):
         res = self.resource(self.model, *args)
         return res.get()
 
-    def _get_resources(self):
+    def _get_resources_with_info(self, get_list_with_info, fields):
+        res_list = []
+        for ident, info in get_list_with_info(*self.model_args, fields=fields):
+            args = self.resource_args + [ident]
+            res = self.resource(self.model, *args)
+            res.info = info
+            res_list.append(res)
+        return res_list
+
+    def _get_resources(self, query=None):
+        if query is None:
+            query = parse_collection_query({})
+        filters = dict(query['filters'])
+        names = filters.pop('name', None)
+        fields = query['fields']
+        if fields is not None:
+            fields = list(set(fields) | set(filters))
+
+        try:
+            fn = getattr(self.model, model_fn(self, 'get_list_with_info'))
+        except AttributeError:
+            pass
+        else:
+            res_list = self._get_resources_with_info(fn, fields)
+            if names is not None:
+                res_list = [res for res in res_list if res.ident in names]
+            return self._page(self._filter(res_list, filters), query)
+
         try:
             get_list = getattr(self.model, model_fn(self, 'get_list'))
-            idents = get_list(*self.model_args)
-            res_list = []
-            for ident in idents:
-                args = self.resource_args + [ident]
-                res = self.resource(self.model, *args)
-                res.lookup()
-                res_list.append(res)
-            return res_list
         except AttributeError:
             return []
+        idents = get_list(*self.model_args)
+        if names is not None:
+            idents = [ident for ident in idents if ident in names]
+        if not filters:
+            # No lookup is needed to decide which items are on the page
+            idents = self._page(idents, query)
+
+        res_list = []
+        for ident in idents:
+            args = self.resource_args + [ident]
+            res_list.append(self.resource(self.model, *args))
+        res_list = self._lookup_resources(res_list)
+        if filters:
+            res_list = self._page(self._filter(res_list, filters), query)
+        return res_list
+
+    def _filter(self, res_list, filters):
+        if not filters:
+            return res_list
+
+        def match(res):
+            data = res.data
+            for key, values in filters.iteritems():
+                if key not in data or unicode(data[key]) not in values:
+                    return False
+            return True
+        return filter(match, res_list)
+
+    def _page(self, items, query):
+        end = None
+        if query['limit'] is not None:
+            end = query['offset'] + query['limit']
+        return items[query['offset']:end]
+
+    def _lookup_resources(self, res_list):
+        """
+        Lookup all Resources on the bounded lookup pool keeping their order.
+        A Resource which is not found (eg. a VM removed after get_list) is
+        left out.  Any other failure fails the whole Collection, as it would
+        without the pool.
+        """
+        pool = get_lookup_pool()
+        if pool is None or len(res_list) <= 1:
+            jobs = [Job(res.lookup, (), {}) for res in res_list]
+            for job in jobs:
+                job.run()
+        else:
+            jobs = pool.map(_pooled_lookup, res_list)
+
+        ret = []
+        for res, job in zip(res_list, jobs):
+            if job.exc_info is None:
+                if job.value is not None:
+                    note_stale_age(job.value)
+                ret.append(res)
+            elif not issubclass(job.exc_info[0], burnet.model.NotFoundError):
+                job.result()
+        return ret
 
     def _cp_dispatch(self, vpath):
         if vpath:
@@ -215,18 +397,29 @@ class Collection(object):
             args = self.resource_args + [ident]
             return self.resource(self.model, *args)
 
-    def get(self):
-        resources = self._get_resources()
+    def get(self, **params):
+        query = parse_collection_query(params)
+        resources = self._get_resources(query)
+        fields = query['fields']
         data = []
         for res in resources:
-            data.append(res.data)
+            item = res.data
+            if fields is not None:
+                item = dict((k, v) for k, v in item.iteritems() if k in fields)
+            data.append(item)
         return burnet.template.render(get_class_name(self), data)
 
     @cherrypy.expose
-    def index(self, *args):
+    def index(self, *args, **kwargs):
         method = validate_method(('GET', 'POST'))
         if method == 'GET':
-            return self.get()
+            reset_stale_age()
+            try:
+                ret = self.get(**kwargs)
+            except burnet.model.ServiceUnavailable, msg:
+                raise cherrypy.HTTPError(503, "Service Unavailable: '%s'" % msg)
+            set_stale_headers()
+            return ret
         elif method == 'POST':
             try:
                 return self.create(*args)
@@ -234,6 +427,10 @@ class Collection(object):
                 raise cherrypy.HTTPError(400, "Missing parameter: '%s'" % param)
             except burnet.model.InvalidParameter, param:
                 raise cherrypy.HTTPError(400, "Invalid parameter: '%s'" % param)
+            except burnet.model.InvalidOperation, msg:
+                raise cherrypy.HTTPError(400, "Invalid operation: '%s'" % msg)
+            except burnet.model.ServiceUnavailable, msg:
+                raise cherrypy.HTTPError(503, "Service Unavailable: '%s'" % msg)
 
 
 class VMs(Collection):
@@ -241,6 +438,20 @@ class VMs(Collection):
         super(VMs, self).__init__(model)
         self.resource = VM
 
+    def create(self, *args):
+        params = parse_request()
+        run_async = params.pop('async', False)
+        if 'count' in params or 'names' in params:
+            taskid = self.model.vms_create_bulk(params)
+        elif run_async:
+            taskid = self.model.vms_create_async(params)
+        else:
+            return self._create(params)
+        # Answer at once with the task creating the VMs
+        cherrypy.response.status = 202
+        cherrypy.response.headers['Location'] = '/tasks/%s' % taskid
+        return Task(self.model, taskid).get()
+
 
 class VM(Resource):
     def __init__(self, model, ident):
@@ -262,6 +473,13 @@ class VM(Resource):
         getattr(self.model, model_fn(self, 'connect'))(self.ident)
         raise cherrypy.InternalRedirect('/vms/%s' % self.ident)
 
+    @action
+    def flatten(self):
+        taskid = getattr(self.model, model_fn(self, 'flatten'))(self.ident)
+        cherrypy.response.status = 202
+        cherrypy.response.headers['Location'] = '/tasks/%s' % taskid
+        return Task(self.model, taskid).get()
+
     @property
     def data(self):
         return {'name': self.ident,
@@ -281,6 +499,29 @@ class VMScreenShot(Resource):
         self.lookup()
         raise cherrypy.InternalRedirect(self.info)
 
+class Mosaic(Resource):
+    """
+    The screenshots of several VMs composed into a single image.
+    """
+    def __init__(self, model, vms=None):
+        super(Mosaic, self).__init__(model)
+        self.model_args = (vms,)
+
+    @cherrypy.expose
+    def index(self, vms=None):
+        if isinstance(vms, basestring):
+            vms = [vms]
+        # The exposed instance is shared by all requests
+        mosaic = Mosaic(self.model, vms)
+        return super(Mosaic, mosaic).index()
+
+    @property
+    def data(self):
+        return {'image': self.info['image'],
+                'width': self.info['width'],
+                'height': self.info['height'],
+                'vms': self.info['vms']}
+
 class Templates(Collection):
     def __init__(self, model):
         super(Templates, self).__init__(model)
@@ -384,14 +625,64 @@ class Task(Resource):
     def __init__(self, model, id):
         super(Task, self).__init__(model, id)
 
+    @cherrypy.expose
+    def index(self, wait=None):
+        if wait is not None:
+            try:
+                self.model_args = (self.ident, float(wait))
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid parameter: 'wait'")
+        return super(Task, self).index()
+
+    @action
+    def cancel(self):
+        getattr(self.model, model_fn(self, 'cancel'))(self.ident)
+        raise cherrypy.InternalRedirect('/tasks/%s' % self.ident)
+
     @property
     def data(self):
         return {'id': self.ident,
                 'status': self.info['status'],
-                'message': self.info['message']}
+                'message': self.info['message'],
+                'progress': self.info.get('progress'),
+                'results': self.info.get('results')}
 
 
 class Tasks(Collection):
     def __init__(self, model):
         super(Tasks, self).__init__(model)
         self.resource = Task
+        self.stats = TaskStats(model)
+
+
+class TaskStats(Resource):
+    """
+    The state of the queue the tasks wait in before they run.
+    """
+    def __init__(self, model):
+        super(TaskStats, self).__init__(model)
+        self.model_args = ()
+
+    @property
+    def data(self):
+        return {'workers': self.info['workers'],
+                'queued': self.info['queued'],
+                'running': self.info['running'],
+                'oldest_wait': self.info['oldest_wait'],
+                'average_wait': self.info['average_wait']}
+
+
+class CacheStats(Resource):
+    """
+    How well the cache in front of the object store does.
+    """
+    def __init__(self, model):
+        super(CacheStats, self).__init__(model)
+        self.model_args = ()
+
+    @property
+    def data(self):
+        return {'hits': self.info['hits'],
+                'misses': self.info['misses'],
+                'entries': self.info['entries'],
+                'size': self.info['size']}
@@ -0,0 +1,202 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import collections
+import copy
+import threading
+import time
+
+from burnet.exception import NotFoundError, ServiceUnavailable
+from burnet.threadpool import ThreadPool
+
+
+_local = threading.local()
+
+
+def reset_stale_age():
+    _local.stale_age = None
+
+
+def note_stale_age(age):
+    """
+    Record that the current request is answered with data which is age
+    seconds old because fresh data could not be read in time.
+    """
+    current = getattr(_local, 'stale_age', None)
+    if current is None or age > current:
+        _local.stale_age = age
+
+
+def get_stale_age():
+    return getattr(_local, 'stale_age', None)
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast after 'threshold' consecutive failures.  Once 'reset_secs'
+    have passed a single call is let through to probe whether the service
+    recovered; its result closes or re-opens the circuit.
+    """
+    def __init__(self, threshold=5, reset_secs=30):
+        self.threshold = threshold
+        self.reset_secs = reset_secs
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at >= self.reset_secs:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self._probing = False
+
+
+class Guard(object):
+    """
+    Run calls into a service which may stall (libvirtd) so that callers
+    never wait longer than a deadline.  A call with a deadline runs on a
+    bounded worker pool; when the deadline expires the caller gets an
+    error while the call completes in the background.  Timeouts and
+    outage errors (as decided by is_outage) open a circuit breaker so
+    later calls fail immediately.
+
+    Results of calls made with a cache key are remembered and, instead of
+    failing, the last known good value is returned and its age recorded
+    with note_stale_age().  A call which finished after its deadline still
+    refreshes the remembered value.  Only the RESULTS most recently used
+    keys are remembered.
+    """
+    TIMEOUT = 10
+    WORKERS = 16
+    RESULTS = 256
+
+    def __init__(self, timeout=None, workers=None, is_outage=None,
+                 breaker=None):
+        self.timeout = timeout or self.TIMEOUT
+        self.pool = ThreadPool(workers or self.WORKERS, 'Guard')
+        self.breaker = breaker or CircuitBreaker()
+        self.is_outage = is_outage or (lambda e: False)
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def call(self, fn, args=(), kwargs=None, key=None, deadline=True):
+        kwargs = kwargs or {}
+        if getattr(_local, 'in_guard', False):
+            # Nested call from a guarded call, already under a deadline
+            return fn(*args, **kwargs)
+
+        if not self.breaker.allow():
+            return self._stale(key, "Service unavailable, retry later")
+
+        if not deadline:
+            try:
+                value = fn(*args, **kwargs)
+            except Exception, e:
+                self._account(e)
+                raise
+            self.breaker.success()
+            return value
+
+        job = self.pool.submit(self._run, fn, args, kwargs, key)
+        if not job.wait(self.timeout):
+            self.breaker.failure()
+            return self._stale(key, "Service did not answer in %i seconds" %
+                               self.timeout)
+        try:
+            value = job.result()
+        except Exception, e:
+            self._account(e)
+            if self.is_outage(e):
+                return self._stale(key, str(e))
+            raise
+        self.breaker.success()
+        return value
+
+    def _account(self, e):
+        if self.is_outage(e):
+            self.breaker.failure()
+        else:
+            # The service answered, even if with an error
+            self.breaker.success()
+
+    def _run(self, fn, args, kwargs, key):
+        _local.in_guard = True
+        try:
+            value = fn(*args, **kwargs)
+        except NotFoundError:
+            if key is not None:
+                with self._lock:
+                    self._results.pop(key, None)
+            raise
+        finally:
+            _local.in_guard = False
+
+        if key is not None:
+            with self._lock:
+                self._results.pop(key, None)
+                self._results[key] = (value, time.time())
+                while len(self._results) > self.RESULTS:
+                    self._results.popitem(last=False)
+        return value
+
+    def forget(self, *args):
+        """
+        Drop the remembered results of calls on the object named by args,
+        i.e. whose tuple key continues the call name with args.
+        """
+        with self._lock:
+            for key in self._results.keys():
+                if isinstance(key, tuple) and key[1:len(args) + 1] == args:
+                    del self._results[key]
+
+    def _stale(self, key, msg):
+        with self._lock:
+            result = self._results.get(key) if key is not None else None
+            if result is not None:
+                self._results[key] = self._results.pop(key)
+        if result is None:
+            raise ServiceUnavailable(msg)
+        value, timestamp = result
+        note_stale_age(time.time() - timestamp)
+        return copy.deepcopy(value)
@@ -23,6 +23,8 @@
 import random
 import subprocess
 import os
+import io
+import sys
 
 try:
     from PIL import Image
@@ -33,17 +35,21 @@ except ImportError:
 
 import burnet.model
 import burnet.vmtemplate
-from burnet.screenshot import VMScreenshot
+from burnet.screenshot import VMScreenshot, ScreenshotScheduler, get_mosaic
 import burnet.vnc
 import config
-from burnet.objectstore import ObjectStore
-from burnet.asynctask import AsyncTask
+from burnet.objectstore import ObjectCache, ObjectStore
+from burnet.asynctask import AsyncTask, TaskRegistry, TaskScheduler
 
 
 class MockModel(object):
-    def __init__(self, objstore_loc=None):
+    def __init__(self, objstore_loc=None, objstore_backend=None):
+        self.objstore = ObjectStore(
+            objstore_loc,
+            cache=ObjectCache(burnet.model.Model.objstore_cache_ttls),
+            backend=objstore_backend)
+        self.scheduler = TaskScheduler()
         self.reset()
-        self.objstore = ObjectStore(objstore_loc)
         self.vnc_port = 5999
 
         # open vnc port
@@ -60,19 +66,27 @@ class MockModel(object):
     def reset(self):
         self._mock_vms = {}
         self._mock_screenshots = {}
+        self._screenshots = ScreenshotScheduler(self._vm_capture_screenshot)
         self._mock_templates = {}
         self._mock_storagepools = {'default': MockStoragePool('default')}
         self._mock_vnc_ports = {}
+        self._creating = set()
+        self._creating_templates = set()
+        self.task_registry = TaskRegistry(self.objstore)
         self.next_taskid = 1
 
     def vm_lookup(self, name):
+        return self._vm_get_info(name)
+
+    def _vm_get_info(self, name, fields=None):
         vm = self._get_vm(name)
-        if vm.info['state'] == 'running':
-            vm.info['screenshot'] = self.vmscreenshot_lookup(name)
-        else:
-            vm.info['screenshot'] = None
-        vm.info['vnc_port'] = self._mock_vnc_ports.get(name, None)
-        return vm.info
+        info = dict(vm.info, screenshot=None, vnc_port=None)
+        if (vm.info['state'] == 'running' and
+                burnet.model.field_wanted(fields, 'screenshot')):
+            info['screenshot'] = '/vms/%s/screenshot' % name
+        if burnet.model.field_wanted(fields, 'vnc_port'):
+            info['vnc_port'] = self._mock_vnc_ports.get(name, None)
+        return info
 
     def vm_delete(self, name):
         self._vmscreenshot_delete(name)
@@ -88,52 +102,167 @@ class MockModel(object):
 
     def vm_stop(self, name):
         self._get_vm(name).info['state'] = 'shutoff'
+        self._screenshots.forget(name)
 
     def vm_connect(self, name):
         vnc_port = burnet.vnc.new_ws_proxy(self.vnc_port)
         self._mock_vnc_ports[name] = vnc_port
 
+    def vm_flatten(self, name):
+        vm = self._get_vm(name)
+        if vm.info['state'] != 'running':
+            raise burnet.model.InvalidOperation(
+                "VM '%s' must be running to be flattened" % name)
+        if vm.base is None:
+            raise burnet.model.InvalidOperation(
+                "VM '%s' has no base image" % name)
+
+        def flatten(cb, opaque):
+            for i, disk in enumerate(vm.disk_paths):
+                cb("Flattening disk %s" % disk['volume'],
+                   progress={'done': i, 'total': len(vm.disk_paths)})
+            vm.base = None
+            cb("VM '%s' flattened" % name, True)
+
+        return self.add_task('/vms/%s' % name, flatten,
+                             task_type='vm_flatten')
+
     def vms_create(self, params):
+        names, t, pool_name = self._vm_prepare(params)
+        try:
+            self._vm_provision(names[0], t, pool_name)
+        finally:
+            self._creating.discard(names[0])
+        return names[0]
+
+    def vms_create_async(self, params):
+        names, t, pool_name = self._vm_prepare(params)
+        name = names[0]
+
+        def create(cb, opaque):
+            try:
+                self._vm_provision(name, t, pool_name, cb)
+            except Exception, e:
+                cb("Unable to create VM '%s': %s" % (name, e), False)
+                return
+            finally:
+                self._creating.discard(name)
+            cb("VM '%s' created" % name, True)
+
+        return self.add_task('/vms/%s' % name, create, task_type='vm_create')
+
+    def vms_create_bulk(self, params):
+        names, t, pool_name = self._vm_prepare(params, bulk=True)
+
+        def create(cb, opaque):
+            results = []
+            try:
+                for i, name in enumerate(names):
+                    try:
+                        self._vm_provision(name, t, pool_name)
+                        results.append({'name': name, 'status': 'finished',
+                                        'message': "VM '%s' created" % name})
+                    except Exception, e:
+                        results.append({'name': name, 'status': 'failed',
+                                        'message': "Unable to create VM "
+                                                   "'%s': %s" % (name, e)})
+                    created = [r for r in results
+                               if r['status'] == 'finished']
+                    cb("Created %i of %i VMs" % (len(created), len(names)),
+                       progress={'done': i + 1, 'total': len(names)},
+                       results=results)
+            finally:
+                self._creating.difference_update(names)
+            cb("Created %i of %i VMs" % (len(created), len(names)),
+               len(created) == len(names), results=results)
+
+        return self.add_task('/vms', create, task_type='vm_create')
+
+    def _vm_prepare(self, params, bulk=False):
         try:
             t_name = burnet.model.template_name_from_uri(params['template'])
         except KeyError, item:
             raise burnet.model.MissingParameter(item)
 
-        name = burnet.model.get_vm_name(params.get('name'), t_name,
-                                        self._mock_vms.keys())
-        if name in self._mock_vms:
+        taken = set(self._mock_vms) | self._creating
+        if bulk:
+            names = burnet.model.get_bulk_vm_names(params, t_name, taken)
+        else:
+            names = [burnet.model.get_vm_name(params.get('name'), t_name,
+                                              taken)]
+        if taken.intersection(names):
             raise burnet.model.InvalidOperation("VM already exists")
         t = self._get_template(t_name)
 
         pool_uri = params.get('storagepool', t.info['storagepool'])
         pool_name = burnet.model.pool_name_from_uri(pool_uri)
+        self._get_storagepool(pool_name)
+        self._creating.update(names)
+        return names, t, pool_name
+
+    def _vm_provision(self, name, t, pool_name, cb=None):
         p = self._get_storagepool(pool_name)
         volumes = t.to_volume_list(name, p.info['path'])
         disk_paths = []
-        for vol_info in volumes:
-            self.storagevolumes_create(pool_name, vol_info)
-            disk_paths.append({'pool': pool_name, 'volume': vol_info['name']})
+        try:
+            for i, vol_info in enumerate(volumes):
+                self.storagevolumes_create(pool_name, vol_info)
+                disk_paths.append({'pool': pool_name,
+                                   'volume': vol_info['name']})
+                if cb is not None:
+                    cb("Created disk %s" % vol_info['name'],
+                       progress={'done': i + 1, 'total': len(volumes)})
+        except:
+            for disk in disk_paths:
+                self.storagevolume_delete(disk['pool'], disk['volume'])
+            raise
 
         vm = MockVM(name, t.info)
         icon = t.info.get('icon')
         if icon:
             vm.info['icon'] = icon
+        vm.template = t.name
+        if t.has_base():
+            vm.base = t.name
 
         vm.disk_paths = disk_paths
         self._mock_vms[name] = vm
-        return name
 
     def vms_get_list(self):
         return sorted(self._mock_vms.keys(), key=unicode.lower)
 
+    def vms_get_list_with_info(self, fields=None):
+        return [(name, self._vm_get_info(name, fields))
+                for name in self.vms_get_list()]
+
     def vmscreenshot_lookup(self, name):
         if self._get_vm(name).info['state'] != 'running':
             raise burnet.model.NotFoundError('No screenshot for stopped vm')
+        return self._screenshots.get(name)
+
+    def mosaic_lookup(self, names=None):
+        if names is None:
+            names = self.vms_get_list()
+        urls = {}
+        for name in names:
+            vm = self._mock_vms.get(name)
+            if vm is None or vm.info['state'] != 'running':
+                continue
+            try:
+                url = self._screenshots.get(name, wait=False)
+            except burnet.model.NotFoundError:
+                continue
+            if url is not None:
+                urls[name] = url
+        return get_mosaic(urls)
+
+    def _vm_capture_screenshot(self, name):
         screenshot = self._mock_screenshots.setdefault(
             name, MockVMScreenshot({'name': name}))
-        return screenshot.lookup()
+        return screenshot.capture()
 
     def _vmscreenshot_delete(self, name):
+        self._screenshots.forget(name)
         screenshot = self._mock_screenshots.get(name)
         if screenshot:
             screenshot.delete()
@@ -144,6 +273,11 @@ class MockModel(object):
         return t.info
 
     def template_delete(self, name):
+        vms = [vm.name for vm in self._mock_vms.values() if vm.base == name]
+        if vms:
+            raise burnet.model.InvalidOperation(
+                "Template '%s' is the base of VMs: %s"
+                % (name, ', '.join(sorted(vms))))
         try:
             del self._mock_templates[name]
         except KeyError:
@@ -151,12 +285,57 @@ class MockModel(object):
 
     def templates_create(self, params):
         name = params['name']
-        if name in self._mock_templates:
+        if name in self._mock_templates or name in self._creating_templates:
             raise burnet.model.InvalidOperation("Template already exists")
-        t = burnet.vmtemplate.VMTemplate(params, scan=True)
-        self._mock_templates[name] = t
+        self._creating_templates.add(name)
+        captured = []
+        try:
+            if 'vm' in params:
+                params = self._template_capture(params)
+                captured = [burnet.model.volume_from_uri(d['base'])
+                            for d in params['disks']]
+            if 'disks' in params:
+                params = dict(params, disks=burnet.model.get_base_disks(
+                    params['disks'], self.storagevolume_lookup))
+            t = burnet.vmtemplate.VMTemplate(params, scan=True)
+            self._mock_templates[name] = t
+        except:
+            exc_info = sys.exc_info()
+            for pool, vol_name in captured:
+                self.storagevolume_delete(pool, vol_name)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self._creating_templates.discard(name)
         return name
 
+    def _template_capture(self, params):
+        params = dict(params)
+        uri = params.pop('vm')
+        try:
+            vm = self._get_vm(burnet.model._uri_to_name('vms', uri))
+        except burnet.model.NotFoundError:
+            raise burnet.model.InvalidParameter(uri)
+        if vm.info['state'] != 'shutoff':
+            raise burnet.model.InvalidOperation(
+                "VM '%s' must be shut off to be captured" % vm.name)
+        if vm.template in self._mock_templates:
+            info = dict(self._mock_templates[vm.template].info)
+            del info['name'], info['disks']
+            params = dict(info, **params)
+
+        params['disks'] = []
+        for i, disk in enumerate(vm.disk_paths):
+            src = self._get_storagevolume(disk['pool'], disk['volume'])
+            vol_name = '%s-base-%i.img' % (params['name'], i)
+            self.storagevolumes_create(disk['pool'],
+                                       {'name': vol_name,
+                                        'capacity': src.info['capacity'],
+                                        'type': 'disk', 'format': 'qcow2'})
+            params['disks'].append({'index': i,
+                                    'base': '/storagepools/%s/storagevolumes/'
+                                            '%s' % (disk['pool'], vol_name)})
+        return params
+
     def templates_get_list(self):
         return self._mock_templates.keys()
 
@@ -217,6 +396,8 @@ class MockModel(object):
             volume.info['capacity'] = params['capacity']
             volume.info['type'] = params['type']
             volume.info['format'] = params['format']
+            volume.info['path'] = os.path.join(
+                self._get_storagepool(pool).info['path'], name)
         except KeyError, item:
             raise burnet.model.MissingParameter(item)
         if name in self._get_storagepool(pool)._volumes:
@@ -235,6 +416,16 @@ class MockModel(object):
     def storagevolume_delete(self, pool, name):
         # firstly, we should check the pool actually exists
         volume = self._get_storagevolume(pool, name)
+        path = volume.info['path']
+        templates = [t.name for t in self._mock_templates.values()
+                     if any(d.get('base_path') == path
+                            for d in t.info['disks'])]
+        vms = [vm.name for vm in self._mock_vms.values()
+               if vm.base in templates]
+        if vms:
+            raise burnet.model.InvalidOperation(
+                "Volume '%s' is the base image of VMs: %s"
+                % (name, ', '.join(sorted(vms))))
         del self._get_storagepool(pool)._volumes[volume.name]
 
     def storagevolume_resize(self, pool, name, size):
@@ -245,20 +436,31 @@ class MockModel(object):
         return self._get_storagepool(pool)._volumes.keys()
 
     def tasks_get_list(self):
-        with self.objstore as session:
-            return session.get_list('task')
+        return self.task_registry.get_list()
 
-    def task_lookup(self, id):
-        with self.objstore as session:
-            return session.get('task', str(id))
+    def task_lookup(self, id, wait=0):
+        return self.task_registry.lookup(id, wait)
 
-    def add_task(self, target_uri, fn, opaque=None):
+    def add_task(self, target_uri, fn, opaque=None, task_type=None,
+                 priority=0):
         id = self.next_taskid
         self.next_taskid = self.next_taskid + 1
-        task = AsyncTask(id, target_uri, fn, self.objstore, opaque)
+        task = AsyncTask(id, target_uri, fn, self.objstore, opaque,
+                         self.scheduler, task_type, priority,
+                         self.task_registry)
 
         return id
 
+    def task_cancel(self, id):
+        self.task_lookup(id)
+        self.scheduler.cancel(id)
+
+    def taskstats_lookup(self):
+        return self.scheduler.stats()
+
+    def cachestats_lookup(self):
+        return self.objstore.cache.stats()
+
     def _get_storagevolume(self, pool, name):
         try:
             return self._get_storagepool(pool)._volumes[name]
@@ -270,6 +472,8 @@ class MockVM(object):
     def __init__(self, name, template_info):
         self.name = name
         self.disk_paths = []
+        self.template = None
+        self.base = None
         self.info = {'state': 'shutoff',
                      'cpu_stats': "35",
                      'memory': template_info['memory'],
@@ -311,7 +515,7 @@ class MockVMScreenshot(VMScreenshot):
         self.coord = MockVMScreenshot.BAR_COORD
         self.background = random.choice(MockVMScreenshot.BACKGROUND_COLOR)
 
-    def _generate_scratch(self, thumbnail):
+    def _generate_scratch(self):
         self.coord = (self.coord[0],
                       self.coord[1],
                       min(MockVMScreenshot.BOX_COORD[2],
@@ -322,11 +526,13 @@ class MockVMScreenshot(VMScreenshot):
         d = ImageDraw.Draw(image)
         d.rectangle(MockVMScreenshot.BOX_COORD, outline='black')
         d.rectangle(self.coord, outline='black', fill='black')
-        image.save(thumbnail)
+        buf = io.BytesIO()
+        image.save(buf, 'PPM')
+        return buf.getvalue()
 
 
-def get_mock_environment():
-    model = MockModel()
+def get_mock_environment(objstore_backend=None):
+    model = MockModel(objstore_backend=objstore_backend)
     for i in xrange(5):
         name = 'test-template-%i' % i
         params = {'name': name}
@@ -21,6 +21,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import re
+import sys
 import threading
 import time
 import logging
@@ -28,6 +29,7 @@ import libvirt
 import functools
 import os
 import json
+import Queue
 try:
     from collections import OrderedDict
 except ImportError:
@@ -37,24 +39,19 @@ import vmtemplate
 import config
 import xmlutils
 import vnc
-from screenshot import VMScreenshot
-from burnet.objectstore import ObjectStore
-from burnet.asynctask import AsyncTask
+from screenshot import VMScreenshot, ScreenshotScheduler, get_mosaic
+from burnet.objectstore import ObjectStore, ObjectCache
+from burnet.asynctask import AsyncTask, TaskRegistry, TaskScheduler
+from burnet.exception import InvalidOperation, InvalidParameter
+from burnet.exception import MissingParameter, NotFoundError, OperationFailed
+from burnet.exception import ServiceUnavailable
+from burnet.guard import Guard, note_stale_age
+from burnet.threadpool import ThreadPool
 
-class NotFoundError(Exception):
-    pass
-
-class OperationFailed(Exception):
-    pass
-
-class MissingParameter(Exception):
-    pass
-
-class InvalidParameter(Exception):
-    pass
-
-class InvalidOperation(Exception):
-    pass
+DOM_VNC_XPATH = "/domain/devices/graphics[@type='vnc']/@port"
+DOM_DISKS_XPATH = "/domain/devices/disk[@device='disk']/source/@file"
+# Most VMs created by one request
+MAX_BULK_VMS = 100
 
 
 def _uri_to_name(collection, uri):
@@ -70,15 +67,128 @@ def template_name_from_uri(uri):
 def pool_name_from_uri(uri):
     return _uri_to_name('storagepools', uri)
 
+def volume_from_uri(uri):
+    m = re.match('/storagepools/(.*?)/storagevolumes/(.*?)/?$', uri)
+    if not m:
+        raise InvalidParameter(uri)
+    return m.groups()
+
+def get_base_disks(disks, lookup):
+    """
+    Return a copy of the template disks in which those with a 'base'
+    storage volume URI also have the path and format of that volume.  Their
+    size defaults to that of the volume and may not be smaller.
+    lookup(pool, name) returns the information of a storage volume.
+    """
+    ret = []
+    for disk in disks:
+        disk = dict(disk)
+        if 'base' in disk:
+            pool, name = volume_from_uri(disk['base'])
+            try:
+                info = lookup(pool, name)
+            except NotFoundError:
+                raise InvalidParameter(disk['base'])
+            disk['base_path'] = info['path']
+            disk['base_format'] = info['format']
+            # Volumes are sized in MiB, disks in GiB
+            size = (info['capacity'] + 1023) >> 10
+            disk.setdefault('size', size)
+            if disk['size'] < size:
+                raise InvalidParameter("Disk smaller than its base image")
+        ret.append(disk)
+    return ret
+
+def _is_connection_error(e):
+    """
+    Tell whether a libvirt error means the connection to libvirtd broke.
+    """
+    if not isinstance(e, libvirt.libvirtError):
+        return False
+    EDOMAINS = (libvirt.VIR_FROM_REMOTE,
+                libvirt.VIR_FROM_RPC)
+    ECODES = (libvirt.VIR_ERR_SYSTEM_ERROR,
+              libvirt.VIR_ERR_INTERNAL_ERROR,
+              libvirt.VIR_ERR_NO_CONNECT,
+              libvirt.VIR_ERR_INVALID_CONN)
+    return e.get_error_domain() in EDOMAINS and e.get_error_code() in ECODES
+
+def _cache_key(name, args, kwargs):
+    def hashable(value):
+        if isinstance(value, (list, set, frozenset)):
+            return tuple(sorted(value))
+        return value
+
+    key = ((name,) + tuple(hashable(arg) for arg in args) +
+           tuple((k, hashable(v)) for k, v in sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def guarded(read=False):
+    """
+    Run a Model method through Model.guard.  Reads get a deadline and may be
+    answered with the last known good result while libvirtd is stalled.
+    Other operations are not cut short but fail fast while the circuit
+    breaker is open.  A successful delete forgets the remembered results
+    for the deleted object.  Reads with arguments which cannot make a cache
+    key are not remembered.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            key = None
+            if read:
+                key = _cache_key(f.__name__, args, kwargs)
+            value = self.guard.call(f, (self,) + args, kwargs, key=key,
+                                    deadline=read)
+            if f.__name__.endswith('_delete'):
+                self.guard.forget(*args)
+            return value
+        return wrapper
+    return decorator
+
+def field_wanted(fields, *names):
+    """
+    Tell whether a get_list_with_info() request needs any of the fields.
+    """
+    return fields is None or any(name in fields for name in names)
+
 def get_vm_name(vm_name, t_name, name_list):
     if vm_name:
         return vm_name
+    return get_vm_names(t_name, 1, name_list)[0]
+
+def get_vm_names(t_name, count, name_list):
+    names = []
     for i in xrange(1, 1000):
         vm_name = "%s-vm-%i" % (t_name, i)
         if vm_name not in name_list:
-            return vm_name
+            names.append(vm_name)
+            if len(names) == count:
+                return names
     raise OperationFailed("Unable to choose a VM name")
 
+def get_bulk_vm_names(params, t_name, name_list):
+    """
+    Choose the names of the VMs created by one request: the given 'names',
+    or 'count' names made from the template name.
+    """
+    names, count = params.get('names'), params.get('count')
+    if (names is None) == (count is None):
+        raise InvalidParameter("Pass either 'names' or 'count'")
+    if names is None:
+        if type(count) is not int or not 0 < count <= MAX_BULK_VMS:
+            raise InvalidParameter('count')
+        return get_vm_names(t_name, count, name_list)
+    if (not isinstance(names, list) or not 0 < len(names) <= MAX_BULK_VMS or
+            not all(isinstance(n, basestring) and n for n in names) or
+            len(set(names)) != len(names)):
+        raise InvalidParameter('names')
+    return names
+
 class Model(object):
     dom_state_map = {0: 'nostate',
                      1: 'running',
@@ -99,76 +209,101 @@ class Model(object):
                        2: 'directory',
                        3: 'network'}
 
-    def __init__(self, libvirt_uri=None, objstore_loc=None):
+    # Seconds the objects read on most requests are cached
+    objstore_cache_ttls = {'template': 300, 'vm': 60, 'screenshot': 60}
+
+    # How many tasks of a type may run at the same time
+    task_limits = {'vm_create': 4}
+    # Threads creating the disks of new VMs
+    DISK_WORKERS = 4
+    # Threads creating the VMs of a bulk request
+    VM_WORKERS = 4
+    # Seconds between the progress reports of a flatten
+    FLATTEN_POLL_SECS = 1
+
+    def __init__(self, libvirt_uri=None, objstore_loc=None,
+                 objstore_backend=None):
         self.libvirt_uri = libvirt_uri or 'qemu:///system'
         self.conn = LibvirtConnection(self.libvirt_uri)
-        self.objstore = ObjectStore(objstore_loc)
+        self.objstore = ObjectStore(
+            objstore_loc, cache=ObjectCache(self.objstore_cache_ttls),
+            backend=objstore_backend)
+        self.inventory = VMInventory(self.libvirt_uri)
+        self.guard = Guard(is_outage=_is_connection_error)
+        self.screenshots = ScreenshotScheduler(self._vm_capture_screenshot)
         self.vnc_ports = {}
-        self.cpu_stats = {}
+        self.scheduler = TaskScheduler(limits=self.task_limits)
+        self.task_registry = TaskRegistry(self.objstore)
+        self.disk_pool = ThreadPool(self.DISK_WORKERS, 'DiskProvision')
+        self.vm_pool = ThreadPool(self.VM_WORKERS, 'VMProvision')
+        # Names of the VMs and templates being created
+        self._creating = set()
+        self._creating_templates = set()
+        self._creating_lock = threading.Lock()
         self.next_taskid = 1
 
-    def _get_cpu_stats(self, name, info):
-        timestamp = time.time()
-        prevCpuTime = 0
-        prevTimestamp = 0
-
-        prevStats = self.cpu_stats.get(name, None)
-        if prevStats is not None:
-            prevTimestamp = prevStats["timestamp"]
-            prevCpuTime = prevStats["cputime"]
-
-        self.cpu_stats[name] = {'timestamp': timestamp, 'cputime': info[4]}
-
-        cpus = info[3]
-        cpuTime = info[4] - prevCpuTime
-        base = (((cpuTime) * 100.0) / ((timestamp - prevTimestamp) * 1000.0 * 1000.0 * 1000.0))
-
-        return max(0.0, min(100.0, base / cpus))
-
     def vm_lookup(self, name):
-        dom = self._get_vm(name)
-        info = dom.info()
-        state = Model.dom_state_map[info[0]]
-        screenshot = None
-        cpu_stats = 0
-        try:
-            if state == 'running':
-                screenshot = self.vmscreenshot_lookup(name)
-                cpu_stats = self._get_cpu_stats(name, info)
-        except NotFoundError:
-            pass
-
+        vm = self.inventory.get(name)
         with self.objstore as session:
             try:
                 extra_info = session.get('vm', name)
             except NotFoundError:
                 extra_info = {}
-        icon = extra_info.get('icon')
+        return self._vm_get_info(vm, extra_info)
 
-        return {'state': state,
-                'cpu_stats': str(cpu_stats),
-                'memory': info[2] >> 10,
-                'screenshot': screenshot,
-                'icon': icon,
-                'vnc_port': self.vnc_ports.get(name, None)}
+    def vms_get_list_with_info(self, fields=None):
+        extra_info = {}
+        if field_wanted(fields, 'icon'):
+            with self.objstore as session:
+                extra_info = dict(session.get_all('vm'))
+
+        ret = []
+        for vm in self.inventory.get_all():
+            name = vm['name']
+            ret.append((name, self._vm_get_info(vm, extra_info.get(name, {}),
+                                                fields)))
+        return sorted(ret, key=lambda x: x[0].lower())
+
+    def _vm_get_info(self, vm, extra_info, fields=None):
+        """
+        Fields left out of 'fields' are not computed and are None.
+        """
+        name = vm['name']
+        state = Model.dom_state_map[vm['state']]
+        info = {'state': state,
+                'cpu_stats': None,
+                'memory': vm['memory'] >> 10,
+                'screenshot': None,
+                'icon': extra_info.get('icon'),
+                'vnc_port': None}
+        if field_wanted(fields, 'cpu_stats'):
+            info['cpu_stats'] = str(vm['cpu_stats'])
+        # The screen is only captured when the screenshot is fetched
+        if state == 'running' and field_wanted(fields, 'screenshot'):
+            info['screenshot'] = '/vms/%s/screenshot' % name
+        if field_wanted(fields, 'vnc_port'):
+            info['vnc_port'] = self.vnc_ports.get(name, None)
+        return info
 
     def _vm_get_disk_paths(self, dom):
         xml = dom.XMLDesc(0)
-        xpath = "/domain/devices/disk[@device='disk']/source/@file"
-        return xmlutils.xpath_get_text(xml, xpath)
+        res = xmlutils.xpath_get_multi(xml, {'disks': DOM_DISKS_XPATH},
+                                       key=dom.UUIDString())
+        return res['disks']
 
+    @guarded()
     def vm_delete(self, name):
         if self._vm_exists(name):
             self._vmscreenshot_delete(name)
             conn = self.conn.get()
             dom = self._get_vm(name)
             paths = self._vm_get_disk_paths(dom)
-            info = self.vm_lookup(name)
 
-            if info['state'] == 'running':
+            if self._vm_get_state(name) == 'running':
                 self.vm_stop(name)
 
             dom.undefine()
+            self.inventory.refresh(name)
 
             for path in paths:
                 vol = conn.storageVolLookupByPath(path)
@@ -177,20 +312,26 @@ class Model(object):
             with self.objstore as session:
                 session.delete('vm', name)
 
+    @guarded()
     def vm_start(self, name):
         dom = self._get_vm(name)
         dom.create()
+        self.inventory.refresh(name)
 
+    @guarded()
     def vm_stop(self, name):
         if self._vm_exists(name):
             dom = self._get_vm(name)
             dom.destroy()
+            self.inventory.refresh(name)
+            self.screenshots.forget(name)
 
+    @guarded()
     def vm_connect(self, name):
         dom = self._get_vm(name)
         xml = dom.XMLDesc(0)
-        expr = "/domain/devices/graphics[@type='vnc']/@port"
-        res = xmlutils.xpath_get_text(xml, expr)
+        res = xmlutils.xpath_get_multi(xml, {'vnc': DOM_VNC_XPATH},
+                                       key=dom.UUIDString())['vnc']
 
         if len(res) < 1:
             raise OperationFailed("Unable to find VNC port in %s" % name)
@@ -199,63 +340,282 @@ class Model(object):
         vnc_port = vnc.new_ws_proxy(vnc_port)
         self.vnc_ports[name] = vnc_port
 
+    @guarded()
+    def vm_flatten(self, name):
+        """
+        Copy the base images into the disks of a running VM on a task, so
+        that it no longer depends on its template.  Return the task id.
+        """
+        if self._vm_get_state(name) != 'running':
+            raise InvalidOperation("VM '%s' must be running to be flattened"
+                                   % name)
+        with self.objstore as session:
+            try:
+                base = session.get('vm', name).get('base')
+            except NotFoundError:
+                base = None
+        if base is None:
+            raise InvalidOperation("VM '%s' has no base image" % name)
+        return self.add_task('/vms/%s' % name, self._vm_flatten_task, name,
+                             task_type='vm_flatten')
+
+    def _vm_flatten_task(self, cb, name):
+        try:
+            self.guard.call(self._vm_flatten, (name, cb), deadline=False)
+        except Exception, e:
+            cb("Unable to flatten VM '%s': %s" % (name, e), False)
+            return
+        cb("VM '%s' flattened" % name, True)
+
+    def _vm_flatten(self, name, cb):
+        conn = self.conn.get()
+        dom = self._get_vm(name)
+        paths = self._vm_get_disk_paths(dom)
+        sizes = [conn.storageVolLookupByPath(path).info()[1]
+                 for path in paths]
+        for i, path in enumerate(paths):
+            # Pull the whole backing chain into the disk, as a block job
+            dom.blockPull(path, 0, 0)
+            try:
+                while True:
+                    info = dom.blockJobInfo(path, 0)
+                    if not info:
+                        break
+                    cb("Flattening disk %s" % path,
+                       progress={'done': i, 'total': len(paths),
+                                 'bytes_done': sum(sizes[:i]) + info['cur'],
+                                 'bytes_total': sum(sizes)})
+                    time.sleep(self.FLATTEN_POLL_SECS)
+            except:
+                dom.blockJobAbort(path, 0)
+                raise
+
+        with self.objstore as session:
+            # The cached copy is shared
+            extra_info = dict(session.get('vm', name))
+            extra_info.pop('base', None)
+            session.store('vm', name, extra_info)
+
+    @guarded()
     def vms_create(self, params):
+        vm = self._vm_prepare(params)[0]
+        try:
+            self._vm_provision(vm)
+        finally:
+            self._vm_release(vm['name'])
+        return vm['name']
+
+    @guarded()
+    def vms_create_async(self, params):
+        """
+        Check the parameters and reserve the VM name, then create the VM on
+        a task.  Return the task id.
+        """
+        vm = self._vm_prepare(params)[0]
+        try:
+            return self.add_task('/vms/%s' % vm['name'], self._vm_create_task,
+                                 vm, task_type='vm_create')
+        except:
+            self._vm_release(vm['name'])
+            raise
+
+    @guarded()
+    def vms_create_bulk(self, params):
+        """
+        Reserve the names of several VMs built from one template, then
+        create them in parallel on a single task.  Return the task id.
+        """
+        vms = self._vm_prepare(params, bulk=True)
+        try:
+            return self.add_task('/vms', self._vm_create_bulk_task, vms,
+                                 task_type='vm_create')
+        except:
+            self._vm_release(*[vm['name'] for vm in vms])
+            raise
+
+    def _vm_create_task(self, cb, vm):
+        try:
+            self.guard.call(self._vm_provision, (vm, cb), deadline=False)
+        except Exception, e:
+            cb("Unable to create VM '%s': %s" % (vm['name'], e), False)
+            return
+        finally:
+            self._vm_release(vm['name'])
+        cb("VM '%s' created" % vm['name'], True)
+
+    def _vm_create_bulk_task(self, cb, vms):
+        # Set when the task is cancelled, to skip the VMs not started yet
+        stop = threading.Event()
+
+        def create(vm):
+            try:
+                if not stop.isSet():
+                    self.guard.call(self._vm_provision, (vm,),
+                                    deadline=False)
+            finally:
+                self._vm_release(vm['name'])
+
+        jobs = [(vm['name'], self.vm_pool.submit(create, vm)) for vm in vms]
+        results = []
+        failed = 0
+        try:
+            for i, (name, job) in enumerate(jobs):
+                job.wait()
+                if job.exc_info is None:
+                    results.append({'name': name, 'status': 'finished',
+                                    'message': "VM '%s' created" % name})
+                else:
+                    failed += 1
+                    results.append({'name': name, 'status': 'failed',
+                                    'message': "Unable to create VM '%s': %s"
+                                    % (name, job.exc_info[1])})
+                cb("Created %i of %i VMs" % (i + 1 - failed, len(jobs)),
+                   progress={'done': i + 1, 'total': len(jobs)},
+                   results=results)
+        except:
+            stop.set()
+            for name, job in jobs:
+                job.wait()
+            raise
+        cb("Created %i of %i VMs" % (len(jobs) - failed, len(jobs)),
+           failed == 0, results=results)
+
+    def _vm_prepare(self, params, bulk=False):
+        """
+        Reserve the names of the VMs to create and look up their template
+        and storage pool once.  Return one dict per VM.
+        """
         try:
             t_name = template_name_from_uri(params['template'])
         except KeyError, item:
             raise MissingParameter(item)
 
-        vm_list = self.vms_get_list()
-        name = get_vm_name(params.get('name'), t_name, vm_list)
-        if name in vm_list:
-            raise InvalidOperation("VM already exists")
-        t = self._get_template(t_name)
+        # VMs being created count as existing ones
+        with self._creating_lock:
+            taken = set(vm['name'] for vm in self.inventory.get_all())
+            taken.update(self._creating)
+            if bulk:
+                names = get_bulk_vm_names(params, t_name, taken)
+            else:
+                names = [get_vm_name(params.get('name'), t_name, taken)]
+            if taken.intersection(names):
+                raise InvalidOperation("VM already exists")
+            self._creating.update(names)
 
+        try:
+            t = self._get_template(t_name)
+            conn = self.conn.get()
+            pool_uri = params.get('storagepool', t.info['storagepool'])
+            pool_name = pool_name_from_uri(pool_uri)
+            pool = conn.storagePoolLookupByName(pool_name)
+            storage_path = self._storagepool_get_xml_info(pool)['path']
+        except:
+            self._vm_release(*names)
+            raise
+        return [{'name': name, 'template': t, 't_name': t_name,
+                 'pool_name': pool_name, 'storage_path': storage_path}
+                for name in names]
+
+    def _vm_release(self, *names):
+        with self._creating_lock:
+            self._creating.difference_update(names)
+
+    def _vm_provision(self, vm, cb=None):
+        """
+        Create the disks of a VM in parallel and define it.  The disks
+        already created are removed if any step fails.
+        """
+        name, t = vm['name'], vm['template']
         conn = self.conn.get()
-        pool_uri = params.get('storagepool', t.info['storagepool'])
-        pool_name = pool_name_from_uri(pool_uri)
-        pool = conn.storagePoolLookupByName(pool_name)
-        xml = pool.XMLDesc(0)
-        storage_path = xmlutils.xpath_get_text(xml, "/pool/target/path")[0]
 
-        # Provision storage:
-        # TODO: Rebase on the storage API once upstream
-        vol_list = t.to_volume_list(name, storage_path)
-        for v in vol_list:
+        def create_volume(v):
+            pool = self.conn.get().storagePoolLookupByName(vm['pool_name'])
             pool.createXML(v['xml'], 0)
 
-        # Store the icon for displaying later
+        # Provision storage:
+        # TODO: Rebase on the storage API once upstream
+        vol_list = t.to_volume_list(name, vm['storage_path'])
+        jobs = [(v, self.disk_pool.submit(create_volume, v))
+                for v in vol_list]
+        bytes_total = sum(v['capacity'] * (1 << 30) for v in vol_list)
+        bytes_done = 0
+        try:
+            for i, (v, job) in enumerate(jobs):
+                job.result()
+                bytes_done += v['capacity'] * (1 << 30)
+                if cb is not None:
+                    cb("Created disk %s" % v['name'],
+                       progress={'done': i + 1, 'total': len(jobs),
+                                 'bytes_done': bytes_done,
+                                 'bytes_total': bytes_total})
+
+            xml = t.to_vm_xml(name, vm['storage_path'])
+            dom = conn.defineXML(xml)
+        except:
+            exc_info = sys.exc_info()
+            for v, job in jobs:
+                if job.wait() and job.exc_info is None:
+                    try:
+                        conn.storageVolLookupByPath(v['path']).delete(0)
+                    except libvirt.libvirtError, e:
+                        logging.error("Unable to remove volume %s: %s" %
+                                      (v['path'], e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.inventory.refresh(name)
+
+        # Remember the template, and its icon for displaying later
+        extra_info = {'template': vm['t_name']}
         icon = t.info.get('icon')
         if icon:
-            with self.objstore as session:
-                session.store('vm', name, {'icon': icon})
-
-        xml = t.to_vm_xml(name, storage_path)
-        dom = conn.defineXML(xml)
-        return name
+            extra_info['icon'] = icon
+        # The template may not go away while the VM uses its base images
+        if t.has_base():
+            extra_info['base'] = vm['t_name']
+        with self.objstore as session:
+            session.store('vm', name, extra_info)
 
     def vms_get_list(self):
-        conn = self.conn.get()
-        ids = conn.listDomainsID()
-        names = map(lambda x: conn.lookupByID(x).name(), ids)
-        names += conn.listDefinedDomains()
-        names = map(lambda x: unicode(x), names)
+        names = [vm['name'] for vm in self.inventory.get_all()]
         return sorted(names, key=unicode.lower)
 
+    def _vm_get_state(self, name):
+        """
+        Cheap lookup of the VM state only, for use within the model.
+        """
+        return Model.dom_state_map[self.inventory.get(name)['state']]
+
     def vmscreenshot_lookup(self, name):
-        dom = self._get_vm(name)
-        d_info = dom.info()
-        if Model.dom_state_map[d_info[0]] != 'running':
+        if self._vm_get_state(name) != 'running':
             raise NotFoundError('No screenshot for stopped vm')
 
+        return self.screenshots.get(name)
+
+    def mosaic_lookup(self, names=None):
+        if names is None:
+            names = [vm['name'] for vm in self.inventory.get_all()]
+        urls = {}
+        for name in names:
+            try:
+                if self._vm_get_state(name) != 'running':
+                    continue
+                # VMs without a ready thumbnail are left out, not waited for
+                url = self.screenshots.get(name, wait=False)
+            except NotFoundError:
+                continue
+            if url is not None:
+                urls[name] = url
+        return get_mosaic(urls)
+
+    def _vm_capture_screenshot(self, name):
         screenshot = self._get_screenshot(name)
-        img_path = screenshot.lookup()
+        ret = screenshot.capture()
         # screenshot info changed after scratch generation
         with self.objstore as session:
             session.store('screenshot', name, screenshot.info)
-        return img_path
+        return ret
 
     def _vmscreenshot_delete(self, name):
+        self.screenshots.forget(name)
         screenshot = self._get_screenshot(name)
         screenshot.delete()
         with self.objstore as session:
@@ -267,36 +627,142 @@ class Model(object):
 
     def template_delete(self, name):
         with self.objstore as session:
+            vms = session.get_list('vm', base=name)
+            if vms:
+                raise InvalidOperation("Template '%s' is the base of VMs: %s"
+                                       % (name, ', '.join(sorted(vms))))
             session.delete('template', name)
 
+    @guarded()
     def templates_create(self, params):
         name = params['name']
-        with self.objstore as session:
-            if name in session.get_list('template'):
+        # Templates being created count as existing ones
+        with self._creating_lock:
+            with self.objstore as session:
+                taken = name in session.get_list('template')
+            if taken or name in self._creating_templates:
                 raise InvalidOperation("Template already exists")
+            self._creating_templates.add(name)
+
+        captured = []
+        try:
+            if 'vm' in params:
+                params = self._template_capture(params)
+                captured = [volume_from_uri(d['base'])
+                            for d in params['disks']]
+            if 'disks' in params:
+                params = dict(params, disks=get_base_disks(
+                    params['disks'], self.storagevolume_lookup))
             t = vmtemplate.VMTemplate(params, scan=True)
-            session.store('template', name, t.info)
+            with self.objstore as session:
+                session.store('template', name, t.info)
+        except:
+            exc_info = sys.exc_info()
+            for pool, vol_name in captured:
+                try:
+                    self._get_storagevolume(pool, vol_name).delete(0)
+                except (NotFoundError, libvirt.libvirtError), e:
+                    logging.error("Unable to remove volume %s: %s" %
+                                  (vol_name, e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            with self._creating_lock:
+                self._creating_templates.discard(name)
         return name
 
+    def _template_capture(self, params):
+        """
+        Copy the disks of a shut off VM into base images next to them.
+        Return the template parameters, which default to those of the
+        template of the VM.
+        """
+        params = dict(params)
+        vm_name = _uri_to_name('vms', params.pop('vm'))
+        try:
+            state = self._vm_get_state(vm_name)
+        except NotFoundError:
+            raise InvalidParameter("/vms/%s" % vm_name)
+        if state != 'shutoff':
+            raise InvalidOperation("VM '%s' must be shut off to be captured"
+                                   % vm_name)
+        with self.objstore as session:
+            try:
+                t_name = session.get('vm', vm_name).get('template')
+            except NotFoundError:
+                t_name = None
+        if t_name is not None:
+            try:
+                info = dict(self._get_template(t_name).info)
+                del info['name'], info['disks']
+                params = dict(info, **params)
+            except NotFoundError:
+                pass
+
+        def copy(arg):
+            i, path = arg
+            conn = self.conn.get()
+            src = conn.storageVolLookupByPath(path)
+            pool = src.storagePoolLookupByVolume()
+            vol_name = '%s-base-%i.img' % (params['name'], i)
+            storage_path = self._storagepool_get_xml_info(pool)['path']
+            xml = _get_volume_xml(name=vol_name,
+                                  capacity=src.info()[1] >> 20,
+                                  path=os.path.join(storage_path, vol_name))
+            pool.createXMLFrom(xml, src, 0)
+            return pool.name(), vol_name
+
+        dom = self._get_vm(vm_name)
+        jobs = self.disk_pool.map(copy,
+                                  enumerate(self._vm_get_disk_paths(dom)))
+        failed = [job for job in jobs if job.exc_info is not None]
+        if failed:
+            for job in jobs:
+                if job.exc_info is None:
+                    self.storagevolume_delete(*job.value)
+            failed[0].result()
+        params['disks'] = [{'index': i,
+                            'base': '/storagepools/%s/storagevolumes/%s'
+                                    % job.value}
+                           for i, job in enumerate(jobs)]
+        return params
+
     def templates_get_list(self):
         with self.objstore as session:
             return session.get_list('template')
 
-    def add_task(self, target_uri, fn, opaque=None):
+    def templates_get_list_with_info(self, fields=None):
+        # Every field comes from the same record, there is nothing to skip
+        with self.objstore as session:
+            templates = session.get_all('template')
+        return [(name, vmtemplate.VMTemplate(params).info)
+                for name, params in templates]
+
+    def add_task(self, target_uri, fn, opaque=None, task_type=None,
+                 priority=0):
         id = self.next_taskid
         self.next_taskid = self.next_taskid + 1
 
-        task = AsyncTask(id, target_uri, fn, self.objstore, opaque)
+        task = AsyncTask(id, target_uri, fn, self.objstore, opaque,
+                         self.scheduler, task_type, priority,
+                         self.task_registry)
 
         return id
 
+    def task_cancel(self, id):
+        self.task_lookup(id)
+        self.scheduler.cancel(id)
+
+    def taskstats_lookup(self):
+        return self.scheduler.stats()
+
+    def cachestats_lookup(self):
+        return self.objstore.cache.stats()
+
     def tasks_get_list(self):
-        with self.objstore as session:
-            return session.get_list('task')
+        return self.task_registry.get_list()
 
-    def task_lookup(self, id):
-        with self.objstore as session:
-            return session.get('task', str(id))
+    def task_lookup(self, id, wait=0):
+        return self.task_registry.lookup(id, wait)
 
     def _vm_exists(self, name):
         try:
@@ -323,6 +789,7 @@ class Model(object):
             params = session.get('template', name)
         return vmtemplate.VMTemplate(params)
 
+    @guarded()
     def storagepools_create(self, params):
         conn = self.conn.get()
         try:
@@ -333,27 +800,42 @@ class Model(object):
         pool = conn.storagePoolDefineXML(xml, 0)
         return name
 
+    @guarded(read=True)
     def storagepool_lookup(self, name):
         pool = self._get_storagepool(name)
+        return self._storagepool_get_info(pool)
+
+    def _storagepool_get_xml_info(self, pool):
+        res = xmlutils.xpath_get_multi(pool.XMLDesc(0),
+                                       {'path': "/pool/target/path",
+                                        'type': "/pool/@type"},
+                                       key=pool.UUIDString())
+        return {'path': res['path'][0], 'type': res['type'][0]}
+
+    def _storagepool_get_info(self, pool, fields=None):
         info = pool.info()
-        xml = pool.XMLDesc(0)
-        path = xmlutils.xpath_get_text(xml, "/pool/target/path")[0]
-        pool_type = xmlutils.xpath_get_text(xml, "/pool/@type")[0]
+        # Only parse the XML when its fields are wanted
+        xml_info = {'path': None, 'type': None}
+        if field_wanted(fields, 'path', 'type'):
+            xml_info = self._storagepool_get_xml_info(pool)
         return {'state': Model.pool_state_map[info[0]],
-                'path': path,
-                'type': pool_type,
+                'path': xml_info['path'],
+                'type': xml_info['type'],
                 'capacity': info[1] >> 20,
                 'allocated': info[2] >> 20,
                 'available': info[3] >> 20}
 
+    @guarded()
     def storagepool_activate(self, name):
         pool = self._get_storagepool(name)
         pool.create(0)
 
+    @guarded()
     def storagepool_deactivate(self, name):
         pool = self._get_storagepool(name)
         pool.destroy()
 
+    @guarded()
     def storagepool_delete(self, name):
         pool = self._get_storagepool(name)
         if pool.isActive():
@@ -361,12 +843,19 @@ class Model(object):
                         "Unable to delete the active storagepool %s" % name)
         pool.undefine()
 
+    @guarded(read=True)
     def storagepools_get_list(self):
         conn = self.conn.get()
         names = conn.listStoragePools()
         names += conn.listDefinedStoragePools()
         return names
 
+    @guarded(read=True)
+    def storagepools_get_list_with_info(self, fields=None):
+        conn = self.conn.get()
+        return [(pool.name(), self._storagepool_get_info(pool, fields))
+                for pool in conn.listAllStoragePools(0)]
+
     def _get_storagepool(self, name):
         conn = self.conn.get()
         try:
@@ -377,6 +866,7 @@ class Model(object):
             else:
                 raise
 
+    @guarded()
     def storagevolumes_create(self, pool, params):
         info = self.storagepool_lookup(pool)
         try:
@@ -389,35 +879,64 @@ class Model(object):
         pool.createXML(xml, 0)
         return name
 
+    @guarded(read=True)
     def storagevolume_lookup(self, pool, name):
         vol = self._get_storagevolume(pool, name)
+        return self._storagevolume_get_info(vol)
+
+    def _storagevolume_get_info(self, vol, fields=None):
         path = vol.path()
         info = vol.info()
-        xml = vol.XMLDesc(0)
-        fmt = xmlutils.xpath_get_text(xml, "/volume/target/format/@type")[0]
+        fmt = None
+        if field_wanted(fields, 'format'):
+            res = xmlutils.xpath_get_multi(vol.XMLDesc(0),
+                                    {'format': "/volume/target/format/@type"},
+                                    key=vol.key())
+            fmt = res['format'][0]
         return {'type': Model.volume_type_map[info[0]],
                 'capacity': info[1] >> 20,
                 'allocation': info[2] >> 20,
                 'path': path,
                 'format': fmt}
 
+    @guarded()
     def storagevolume_wipe(self, pool, name):
         volume = self._get_storagevolume(pool, name)
         volume.wipePattern(libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO, 0)
 
+    @guarded()
     def storagevolume_delete(self, pool, name):
         volume = self._get_storagevolume(pool, name)
-        volume.delete(0)
-
+        path = volume.path()
+        with self.objstore as session:
+            for t_name in session.get_list('template'):
+                disks = session.get('template', t_name).get('disks', [])
+                if not any(d.get('base_path') == path for d in disks):
+                    continue
+                vms = session.get_list('vm', base=t_name)
+                if vms:
+                    raise InvalidOperation(
+                        "Volume '%s' is the base image of VMs: %s"
+                        % (name, ', '.join(sorted(vms))))
+            volume.delete(0)
+
+    @guarded()
     def storagevolume_resize(self, pool, name, size):
         size = size << 20
         volume = self._get_storagevolume(pool, name)
         volume.resize(size, 0)
 
+    @guarded(read=True)
     def storagevolumes_get_list(self, pool):
         pool = self._get_storagepool(pool)
         return pool.listVolumes()
 
+    @guarded(read=True)
+    def storagevolumes_get_list_with_info(self, pool, fields=None):
+        pool = self._get_storagepool(pool)
+        return [(vol.name(), self._storagevolume_get_info(vol, fields))
+                for vol in pool.listAllVolumes(0)]
+
     def _get_storagevolume(self, pool, name):
         pool = self._get_storagepool(pool)
         try:
@@ -435,7 +954,8 @@ class Model(object):
             except NotFoundError:
                 params = {'name': name}
                 session.store('screenshot', name, params)
-        return LibvirtVMScreenshot(params, self.conn)
+        # The cached copy is shared
+        return LibvirtVMScreenshot(dict(params), self.conn)
 
 
 class LibvirtVMScreenshot(VMScreenshot):
@@ -443,18 +963,18 @@ class LibvirtVMScreenshot(VMScreenshot):
         VMScreenshot.__init__(self, vm_name)
         self.conn = conn
 
-    def _generate_scratch(self, thumbnail):
+    def _generate_scratch(self):
         def handler(stream, buf, opaque):
-            fd = opaque
-            os.write(fd, buf)
+            opaque.append(buf)
 
-        fd = os.open(thumbnail, os.O_WRONLY | os.O_TRUNC | os.O_CREAT, 0644)
+        chunks = []
+        stream = None
         try:
             conn = self.conn.get()
             dom = conn.lookupByName(self.vm_name)
             stream = conn.newStream(0)
             mimetype = dom.screenshot(stream, 0, 0)
-            stream.recvAll(handler, fd)
+            stream.recvAll(handler, chunks)
         except libvirt.libvirtError:
             try:
                 stream.abort()
@@ -464,8 +984,47 @@ class LibvirtVMScreenshot(VMScreenshot):
                                 self.vm_name)
         else:
             stream.finish()
-        finally:
-            os.close(fd)
+        return ''.join(chunks)
+
+
+def _get_vms_info(conn):
+    """
+    Enumerate all domains in one sweep.  Return a list of (dom, info)
+    pairs where info has the same layout as the result of dom.info().
+    """
+    try:
+        flags = (libvirt.VIR_DOMAIN_STATS_STATE |
+                 libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                 libvirt.VIR_DOMAIN_STATS_BALLOON |
+                 libvirt.VIR_DOMAIN_STATS_VCPU)
+        records = conn.getAllDomainStats(flags, 0)
+    except AttributeError:
+        # libvirt older than 1.2.8 has no bulk statistics API
+        records = None
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+            raise
+        records = None
+
+    if records is None:
+        return [(dom, dom.info()) for dom in conn.listAllDomains(0)]
+    return [(dom, _stats_to_info(dom, stats)) for dom, stats in records]
+
+
+def _stats_to_info(dom, stats):
+    """
+    Convert a getAllDomainStats() record to the layout of dom.info():
+    [state, maxMem, memory, nrVirtCpu, cpuTime]
+    """
+    try:
+        return [stats['state.state'],
+                stats['balloon.maximum'],
+                stats['balloon.current'],
+                stats['vcpu.current'],
+                stats.get('cpu.time', 0)]
+    except KeyError:
+        # Some drivers do not report balloon or vcpu data for every domain
+        return dom.info()
 
 
 def _get_pool_xml(**kwargs):
@@ -511,27 +1070,337 @@ def _get_volume_xml(**kwargs):
     return xml
 
 
-class LibvirtConnection(object):
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
+
+
+def start_event_loop():
+    """
+    Register the default libvirt event loop implementation and run it in a
+    daemon thread.  Connections which need domain events must be opened
+    after this is called.
+    """
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        t = threading.Thread(target=run, name='LibvirtEventLoop')
+        t.setDaemon(True)
+        t.start()
+        _event_loop_started = True
+
+
+class VMInventory(object):
+    """
+    An in-memory view of all domains so that VM reads never wait on
+    libvirtd.  Domain lifecycle events refresh a single domain and a full
+    sweep every RECONCILE_SECS catches up with missed events and samples the
+    CPU time used for cpu_stats.  The domain XML is only read again when a
+    domain is new or changed state.
+    """
+    RECONCILE_SECS = 10
+
     def __init__(self, uri):
         self.uri = uri
-        self._connections = {}
-        self._connectionLock = threading.Lock()
+        self._conn = None
+        self._vms = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._conn_lock = threading.Lock()
+        self._pending = Queue.Queue()
+        self._thread = None
+        self.last_reconcile = None
+        self.log = logging.getLogger('VMInventory')
+
+    def get(self, name):
+        self._ensure_started()
+        self._check_age()
+        with self._lock:
+            try:
+                return dict(self._vms[name])
+            except KeyError:
+                raise NotFoundError("Virtual Machine '%s' not found" % name)
+
+    def get_all(self):
+        self._ensure_started()
+        self._check_age()
+        with self._lock:
+            return [dict(vm) for vm in self._vms.itervalues()]
+
+    def _check_age(self):
+        # Flag the answer as stale when libvirtd has not been reachable for
+        # a couple of reconcile periods
+        age = time.time() - self.last_reconcile
+        if age > 2 * self.RECONCILE_SECS:
+            note_stale_age(age)
+
+    def refresh(self, name):
+        """
+        Read one domain from libvirt now, eg. right after changing it.
+        """
+        self._ensure_started()
+        conn = self._get_conn()
+        try:
+            dom = conn.lookupByName(name)
+            self._update(dom, dom.info(), time.time(), True)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            with self._lock:
+                self._vms.pop(name, None)
+
+    def reconcile(self):
+        conn = self._get_conn()
+        now = time.time()
+        names = set()
+        for dom, info in _get_vms_info(conn):
+            names.add(self._update(dom, info, now))
+        with self._lock:
+            for name in set(self._vms) - names:
+                del self._vms[name]
+        self.last_reconcile = now
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            start_event_loop()
+            self.reconcile()
+            self._thread = threading.Thread(target=self._run,
+                                            name='VMInventory')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _get_conn(self):
+        with self._conn_lock:
+            if self._conn is not None and not _is_alive(self._conn):
+                _close(self._conn)
+                self._conn = None
+            if self._conn is None:
+                conn = libvirt_open(self.uri)
+                try:
+                    conn.domainEventRegisterAny(None,
+                                    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                    self._lifecycle_cb, None)
+                except libvirt.libvirtError as e:
+                    self.log.warning("Domain events unavailable, relying on "
+                                     "periodic reconcile: %s" % e)
+                self._conn = conn
+            return self._conn
+
+    def _reset_conn(self):
+        # Reconnect and register for events again on next use
+        with self._conn_lock:
+            if self._conn is not None:
+                _close(self._conn)
+                self._conn = None
+
+    def _lifecycle_cb(self, conn, dom, event, detail, opaque):
+        # Runs in the event loop thread which must not block on libvirt
+        self._pending.put(dom.name())
+
+    def _run(self):
+        next_reconcile = time.time() + self.RECONCILE_SECS
+        while True:
+            timeout = max(0, next_reconcile - time.time())
+            try:
+                name = self._pending.get(timeout=timeout)
+            except Queue.Empty:
+                name = None
+
+            try:
+                if name is None:
+                    # Do not retry a failed sweep before the next period
+                    next_reconcile = time.time() + self.RECONCILE_SECS
+                    self.reconcile()
+                else:
+                    self.refresh(name)
+            except libvirt.libvirtError as e:
+                self.log.error("Unable to update VM inventory: %s" % e)
+                self._reset_conn()
+            except Exception:
+                # Keep the inventory up to date whatever went wrong
+                self.log.exception("Unable to update VM inventory")
+
+    def _update(self, dom, info, timestamp, reload_xml=False):
+        name = unicode(dom.name())
+        with self._lock:
+            prev = self._vms.get(name)
+
+        vm = {'name': name,
+              'state': info[0],
+              'max_memory': info[1],
+              'memory': info[2],
+              'vcpus': info[3],
+              'cpu_time': info[4],
+              'timestamp': timestamp,
+              'cpu_stats': 0.0}
+
+        if prev is not None and prev['state'] == info[0] and not reload_xml:
+            for key in ('uuid', 'vnc_port', 'disk_paths'):
+                vm[key] = prev[key]
+        else:
+            vm['uuid'] = dom.UUIDString()
+            res = xmlutils.xpath_get_multi(dom.XMLDesc(0),
+                                           {'vnc': DOM_VNC_XPATH,
+                                            'disks': DOM_DISKS_XPATH},
+                                           key=vm['uuid'])
+            vm['vnc_port'] = int(res['vnc'][0]) if res['vnc'] else None
+            vm['disk_paths'] = res['disks']
+
+        if prev is not None and timestamp > prev['timestamp']:
+            elapsed = (timestamp - prev['timestamp']) * 1000.0 * 1000.0 * 1000.0
+            used = (vm['cpu_time'] - prev['cpu_time']) * 100.0 / elapsed
+            vm['cpu_stats'] = max(0.0, min(100.0, used / max(1, vm['vcpus'])))
+        elif prev is not None:
+            vm['cpu_stats'] = prev['cpu_stats']
+
+        with self._lock:
+            self._vms[name] = vm
+        return name
+
+
+def libvirt_open(uri, retries=5, delay=2):
+    """
+    Open a connection to libvirt retrying while libvirtd is unavailable
+    (eg. restarting) and enable keepalive so a dead daemon is noticed.
+    """
+    log = logging.getLogger('LibvirtConnection')
+    start_event_loop()
+    while True:
+        retries = retries - 1
+        try:
+            conn = libvirt.open(uri)
+            break
+        except libvirt.libvirtError:
+            log.error('Unable to connect to libvirt.')
+            if retries <= 0:
+                raise
+        time.sleep(delay)
 
-    def get(self, conn_id=0):
+    try:
+        conn.setKeepAlive(LibvirtConnection.KEEPALIVE_INTERVAL,
+                          LibvirtConnection.KEEPALIVE_COUNT)
+    except libvirt.libvirtError:
+        # Local drivers (eg. test:///) do not support keepalive
+        pass
+    return conn
+
+
+def _is_alive(conn):
+    try:
+        return conn.isAlive() == 1
+    except libvirt.libvirtError:
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except libvirt.libvirtError:
+        pass
+
+
+class LibvirtConnection(object):
+    """
+    A pool of POOL_SIZE connections to libvirt.  Every thread is leased one
+    connection of the pool so concurrent requests do not serialize on a
+    single RPC channel.  A connection is health checked each time it is
+    handed out, and dropped and closed as soon as a call fails because
+    libvirtd went away, so the next get() reconnects.
+    """
+    POOL_SIZE = 4
+    # Keepalive probes every KEEPALIVE_INTERVAL seconds.  The connection is
+    # closed after KEEPALIVE_COUNT probes went unanswered.
+    KEEPALIVE_INTERVAL = 5
+    KEEPALIVE_COUNT = 3
+
+    def __init__(self, uri, size=None):
+        self.uri = uri
+        self.size = size or self.POOL_SIZE
+        self._connections = [None] * self.size
+        # Reentrant as a failing call made under the lock drops its own slot
+        self._locks = [threading.RLock() for i in xrange(self.size)]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_slot = 0
+
+    def _get_slot(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            with self._lock:
+                slot = self._next_slot
+                self._next_slot = (self._next_slot + 1) % self.size
+            self._local.slot = slot
+        return slot
+
+    def get(self, conn_id=None):
+        """
+        Return the connection leased to the current thread, or the one at
+        conn_id in the pool, opening a new one if it is missing or dead.
+        """
+        if conn_id is None:
+            slot = self._get_slot()
+        else:
+            slot = conn_id % self.size
+
+        with self._locks[slot]:
+            conn = self._connections[slot]
+            if conn is not None and _is_alive(conn):
+                return conn
+            if self._connections[slot] is conn:
+                self._connections[slot] = None
+        if conn is not None:
+            _close(conn)
+
+        # Not under the lock, as libvirt_open() sleeps between retries
+        conn = libvirt_open(self.uri)
+        self._wrap(conn, slot)
+        with self._locks[slot]:
+            current = self._connections[slot]
+            if current is None:
+                self._connections[slot] = conn
+                return conn
+        # Another thread of the slot reconnected first
+        _close(conn)
+        return current
+
+    def _wrap(self, conn, slot):
         """
-        Return current connection to libvirt or open a new one.
+        Wrap all callable libvirt methods so a broken connection is removed
+        from the pool as soon as a call fails.
         """
         log = logging.getLogger('LibvirtConnection')
 
-        with self._connectionLock:
-            conn = self._connections.get(conn_id)
-            if not conn:
-                # TODO: Retry
-                conn = libvirt.open(self.uri)
-                self._connections[conn_id] = conn
-                # In case we're running into troubles with keeping the connections
-                # alive we should place here:
-                # conn.setKeepAlive(interval=5, count=3)
-                # However the values need to be considered wisely to not affect
-                # hosts which are hosting a lot of virtual machines
-            return conn
+        def wrapMethod(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                try:
+                    return f(*args, **kwargs)
+                except libvirt.libvirtError as e:
+                    if _is_connection_error(e):
+                        log.error('Connection to libvirt broken. '
+                                  'Reconnecting. ecode: %d edom: %d' %
+                                  (e.get_error_code(),
+                                   e.get_error_domain()))
+                        with self._locks[slot]:
+                            dropped = self._connections[slot] is conn
+                            if dropped:
+                                self._connections[slot] = None
+                        if dropped:
+                            _close(conn)
+                    raise
+            return wrapper
+
+        for name in dir(libvirt.virConnect):
+            method = getattr(conn, name)
+            if callable(method) and not name.startswith('_'):
+                setattr(conn, name, wrapMethod(method))
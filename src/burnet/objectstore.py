@@ -20,97 +20,611 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import contextlib
 import json
+import operator
 import threading
 import sqlite3
+import time
+import Queue
+
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
+
 import config
-import burnet.model
+from burnet.exception import InvalidParameter, NotFoundError
+from burnet.exception import OperationFailed, ServiceUnavailable
 
 
-class ObjectStoreSession(object):
-    def __init__(self, conn):
-        self.conn = conn
+# Marks objects known not to exist in the cache
+_MISSING = object()
+
+# Attributes of the objects which sqlite filters on with an index
+INDEXES = {'task': ('status', 'target_uri'),
+           'vm': ('template', 'base'),
+           'screenshot': ('mtime',)}
+
+_OPERATORS = {'=': operator.eq, '!=': operator.ne,
+              '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+
+
+def _parse_filter(value):
+    if not isinstance(value, tuple):
+        return '=', value
+    op, value = value
+    if op not in _OPERATORS:
+        raise InvalidParameter("Unknown operator '%s'" % op)
+    return op, value
+
+
+def match(data, filters):
+    """
+    Tell whether an object matches all the filters.  Filters map attributes
+    to a value they must equal or to an (operator, value) tuple, such as
+    ('<', 10).
+    """
+    for attr, value in filters.iteritems():
+        op, value = _parse_filter(value)
+        if attr not in data or not _OPERATORS[op](data[attr], value):
+            return False
+    return True
+
+
+def index_attrs(indexes, obj_type, data):
+    """
+    Return the indexed attributes of an object, None if its type has none.
+    Only scalar values are indexed.
+    """
+    if obj_type not in indexes:
+        return None
+    return dict((attr, data[attr]) for attr in indexes[obj_type]
+                if isinstance(data.get(attr), (basestring, int, long, float)))
+
+
+class ObjectCache(object):
+    """
+    A size bounded LRU cache of decoded objects in front of an ObjectStore.
+    ttls maps the object types to cache to how many seconds their entries
+    live; other types always go to the database.  Objects are shared by
+    all the readers so they must not be modified.
 
-    def get_list(self, obj_type):
-        c = self.conn.cursor()
-        res = c.execute('SELECT id FROM objects WHERE type=?', (obj_type,))
-        return [x[0] for x in res]
+    Writes through the ObjectStore the cache belongs to invalidate the
+    entries they touch once committed.  Writes by other processes are only
+    seen when the entries expire.
+    """
+    SIZE = 1024
+
+    def __init__(self, ttls, size=None):
+        self.ttls = ttls
+        self.size = size or self.SIZE
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = dict((obj_type, 0) for obj_type in ttls)
+        self._lock = threading.Lock()
 
     def get(self, obj_type, ident):
-        c = self.conn.cursor()
-        res = c.execute('SELECT json FROM objects WHERE type=? AND id=?',
-                        (obj_type, ident))
-        try:
-            jsonstr = res.fetchall()[0][0]
-        except IndexError:
-            self.conn.rollback()
-            raise burnet.model.NotFoundError(ident)
-        return json.loads(jsonstr)
+        """
+        Return the cached object, _MISSING if the object is known not to
+        exist or None on a cache miss.
+        """
+        if obj_type not in self.ttls:
+            return None
+        key = (obj_type, ident)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def generation(self, obj_type):
+        return self._generations.get(obj_type)
+
+    def put(self, obj_type, ident, value, generation):
+        """
+        Cache a value read from the database unless an object of that type
+        was written since generation() was taken before the read.
+        """
+        if obj_type not in self.ttls:
+            return
+        with self._lock:
+            if self._generations[obj_type] != generation:
+                return
+            self._entries.pop((obj_type, ident), None)
+            self._entries[(obj_type, ident)] = \
+                (value, time.time() + self.ttls[obj_type])
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            for obj_type, ident in keys:
+                if obj_type in self.ttls:
+                    self._generations[obj_type] += 1
+                    self._entries.pop((obj_type, ident), None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'size': self.size}
+
+
+class SqliteConnection(object):
+    # Keep below the sqlite limit of 999 variables per statement
+    MAX_VARS = 500
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, obj_type, ident):
+        res = self.db.execute('SELECT json FROM objects WHERE type=? AND id=?',
+                              (obj_type, ident))
+        row = res.fetchone()
+        return row and row[0]
+
+    def _select(self, columns, obj_type, filters):
+        sql = 'SELECT %s FROM objects WHERE type=?' % columns
+        args = [obj_type]
+        for attr, value in sorted((filters or {}).iteritems()):
+            op, value = _parse_filter(value)
+            sql += (' AND id IN (SELECT id FROM object_index WHERE type=? '
+                    'AND attr=? AND value %s ?)' % op)
+            args += [obj_type, attr, value]
+        return self.db.execute(sql, args)
+
+    def get_list(self, obj_type, filters=None):
+        return [x[0] for x in self._select('id', obj_type, filters)]
+
+    def get_all(self, obj_type, filters=None):
+        return self._select('id, json', obj_type, filters).fetchall()
+
+    def get_many(self, obj_type, idents):
+        idents = list(idents)
+        ret = {}
+        for i in xrange(0, len(idents), self.MAX_VARS):
+            chunk = idents[i:i + self.MAX_VARS]
+            marks = ','.join('?' * len(chunk))
+            res = self.db.execute('SELECT id, json FROM objects WHERE type=? '
+                                  'AND id IN (%s)' % marks, [obj_type] + chunk)
+            ret.update(res)
+        return ret
+
+    def put_many(self, rows):
+        """
+        Create or replace objects from (id, type, json, attrs) rows, where
+        attrs are the indexed attributes.
+        """
+        self.db.executemany('INSERT OR REPLACE INTO objects (id, type, json) '
+                            'VALUES (?,?,?)',
+                            [row[:3] for row in rows])
+        self.put_index([(ident, obj_type, attrs)
+                        for ident, obj_type, jsonstr, attrs in rows])
+
+    def put_index(self, rows):
+        rows = [row for row in rows if row[2] is not None]
+        self.db.executemany('DELETE FROM object_index WHERE type=? AND id=?',
+                            [(obj_type, ident) for ident, obj_type, a in rows])
+        self.db.executemany('INSERT INTO object_index (type, id, attr, value) '
+                            'VALUES (?,?,?,?)',
+                            [(obj_type, ident, attr, value)
+                             for ident, obj_type, attrs in rows
+                             for attr, value in attrs.iteritems()])
 
     def delete(self, obj_type, ident):
-        c = self.conn.cursor()
-        c.execute('DELETE FROM objects WHERE type=? AND id=?',
-                  (obj_type, ident))
+        c = self.db.execute('DELETE FROM objects WHERE type=? AND id=?',
+                            (obj_type, ident))
         if c.rowcount != 1:
+            return False
+        self.db.execute('DELETE FROM object_index WHERE type=? AND id=?',
+                        (obj_type, ident))
+        return True
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+
+class SqliteBackend(object):
+    """
+    Keep the objects in a sqlite database in WAL mode, where readers do not
+    wait for each other nor for the writer.
+    """
+    # Safe with WAL: a power loss may only lose the last commits
+    synchronous = 'NORMAL'
+
+    # Statements upgrading the schema to each version
+    MIGRATIONS = [
+        # 1: one JSON document per object
+        ["""CREATE TABLE IF NOT EXISTS objects
+            (id TEXT, type TEXT, json TEXT, PRIMARY KEY (id, type))"""],
+        # 2: attributes to filter the objects on
+        ["""CREATE TABLE object_index (type TEXT, id TEXT, attr TEXT, value,
+            PRIMARY KEY (type, id, attr))""",
+         "CREATE INDEX object_index_value ON object_index (type, attr, value)",
+         "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)"],
+    ]
+
+    def __init__(self, location=None):
+        self.location = location or config.get_object_store()
+
+    def connect(self):
+        db = sqlite3.connect(self.location, timeout=10,
+                             check_same_thread=False)
+        db.execute('PRAGMA synchronous=%s' % self.synchronous)
+        return SqliteConnection(db)
+
+    def setup(self, conn, indexes):
+        db = conn.db
+        db.execute('PRAGMA journal_mode=WAL')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version > len(self.MIGRATIONS):
+            raise OperationFailed(
+                "Object store %s has schema version %i, newer than %i" %
+                (self.location, version, len(self.MIGRATIONS)))
+        for version in xrange(version, len(self.MIGRATIONS)):
+            # Each migration is applied as a whole or not at all
+            db.executescript('BEGIN; %s; PRAGMA user_version=%i; COMMIT;' %
+                             ('; '.join(self.MIGRATIONS[version]),
+                              version + 1))
+
+        # Because the tasks are regarded as temporary resource, the task
+        # states are purged every time the daemon startup
+        db.execute("DELETE FROM objects WHERE type = 'task'")
+        db.execute("DELETE FROM object_index WHERE type = 'task'")
+
+        spec = json.dumps(indexes, sort_keys=True)
+        res = db.execute("SELECT value FROM meta WHERE key = 'indexes'")
+        if res.fetchone() != (spec,):
+            self._reindex(conn, indexes)
+            db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                       "VALUES ('indexes', ?)", (spec,))
+        conn.commit()
+
+    def _reindex(self, conn, indexes):
+        conn.db.execute('DELETE FROM object_index')
+        for obj_type in indexes:
+            rows = conn.get_all(obj_type)
+            conn.put_index([(ident, obj_type, index_attrs(indexes, obj_type,
+                                                          json.loads(jsonstr)))
+                            for ident, jsonstr in rows])
+
+
+class NoSyncSqliteBackend(SqliteBackend):
+    """
+    A sqlite database which does not wait for the data to reach the disk.
+    A crash of the host may lose or corrupt it, so it suits a database on
+    tmpfs or one which can be thrown away.
+    """
+    synchronous = 'OFF'
+
+
+class MemoryConnection(object):
+    """
+    Writes are kept aside until commit so that other connections do not see
+    them before, as with sqlite.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        # (type, id) -> json, None for deleted objects
+        self.pending = {}
+
+    def get(self, obj_type, ident):
+        return self.get_many(obj_type, [ident]).get(ident)
+
+    def get_list(self, obj_type, filters=None):
+        return [ident for ident, jsonstr in self.get_all(obj_type, filters)]
+
+    def get_all(self, obj_type, filters=None):
+        with self.backend.lock:
+            objects = dict(self.backend.objects.get(obj_type, {}))
+        for (pending_type, ident), jsonstr in self.pending.iteritems():
+            if pending_type != obj_type:
+                continue
+            if jsonstr is None:
+                objects.pop(ident, None)
+            else:
+                objects[ident] = jsonstr
+        if filters:
+            return [(ident, jsonstr) for ident, jsonstr in objects.iteritems()
+                    if match(json.loads(jsonstr), filters)]
+        return objects.items()
+
+    def get_many(self, obj_type, idents):
+        ret = {}
+        with self.backend.lock:
+            objects = self.backend.objects.get(obj_type, {})
+            for ident in idents:
+                jsonstr = self.pending.get((obj_type, ident),
+                                           objects.get(ident))
+                if jsonstr is not None:
+                    ret[ident] = jsonstr
+        return ret
+
+    def put_many(self, rows):
+        for ident, obj_type, jsonstr, attrs in rows:
+            self.pending[(obj_type, ident)] = jsonstr
+
+    def delete(self, obj_type, ident):
+        if self.get(obj_type, ident) is None:
+            return False
+        self.pending[(obj_type, ident)] = None
+        return True
+
+    def commit(self):
+        with self.backend.lock:
+            for (obj_type, ident), jsonstr in self.pending.iteritems():
+                objects = self.backend.objects.setdefault(obj_type, {})
+                if jsonstr is None:
+                    objects.pop(ident, None)
+                else:
+                    objects[ident] = jsonstr
+        self.pending.clear()
+
+    def rollback(self):
+        self.pending.clear()
+
+
+class MemoryBackend(object):
+    """
+    Keep the objects in memory only, for tests and deployments where they
+    need not survive a restart.
+    """
+    def __init__(self, location=None):
+        # type -> id -> json
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    def setup(self, conn, indexes):
+        pass
+
+
+BACKENDS = {'sqlite': SqliteBackend,
+            'nosync': NoSyncSqliteBackend,
+            'memory': MemoryBackend}
+
+
+def get_backend(name, location=None):
+    try:
+        return BACKENDS[name](location)
+    except KeyError:
+        raise InvalidParameter(
+            "Unknown object store backend '%s', use one of: %s" %
+            (name, ', '.join(sorted(BACKENDS))))
+
+
+class ObjectStoreSession(object):
+    def __init__(self, conn, store):
+        self.conn = conn
+        self.objstore = store
+        self.writing = False
+        self._transaction = 0
+        # Objects written but not committed yet
+        self._dirty = set()
+
+    def _begin_write(self):
+        # Readers run concurrently, writers one at a time.  A session keeps
+        # the write lock from its first write until it ends.  The lock is
+        # reentrant so that sessions nested on one thread may write too.
+        if not self.writing:
+            self.objstore._write_lock.acquire()
+            self.writing = True
+
+    def _commit(self):
+        if not self._transaction:
+            self.conn.commit()
+            self._invalidate()
+
+    def _rollback(self):
+        # Within a transaction leave it to transaction() to roll back
+        if not self._transaction:
             self.conn.rollback()
-            raise burnet.model.NotFoundError(ident)
-        self.conn.commit()
+            self._dirty.clear()
+
+    def _invalidate(self):
+        cache = self.objstore.cache
+        if cache is not None and self._dirty:
+            cache.invalidate(self._dirty)
+        self._dirty.clear()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group several writes so they are committed at once, or not at all
+        if the block raises.
+        """
+        self._transaction += 1
+        try:
+            yield self
+        except:
+            self._transaction -= 1
+            if not self._transaction:
+                self.conn.rollback()
+                self._dirty.clear()
+            raise
+        self._transaction -= 1
+        self._commit()
+
+    def _split_filters(self, obj_type, filters):
+        indexed, others = {}, {}
+        for attr, value in filters.iteritems():
+            if attr in self.objstore.indexes.get(obj_type, ()):
+                indexed[attr] = value
+            else:
+                others[attr] = value
+        return indexed, others
+
+    def get_list(self, obj_type, **filters):
+        """
+        Return the ids of the objects of a type which match the filters, see
+        match().  Filters on indexed attributes run in the database.
+        """
+        indexed, others = self._split_filters(obj_type, filters)
+        if others:
+            return [ident for ident, data in self.get_all(obj_type, **filters)]
+        return self.conn.get_list(obj_type, indexed)
+
+    def get_all(self, obj_type, **filters):
+        indexed, others = self._split_filters(obj_type, filters)
+        ret = [(ident, json.loads(jsonstr))
+               for ident, jsonstr in self.conn.get_all(obj_type, indexed)]
+        if others:
+            ret = [(ident, data) for ident, data in ret if match(data, others)]
+        return ret
+
+    def get_many(self, obj_type, idents):
+        """
+        Return the (id, data) pairs of the given objects which exist, in the
+        order of idents.
+        """
+        found = self.conn.get_many(obj_type, idents)
+        return [(ident, json.loads(found[ident]))
+                for ident in idents if ident in found]
+
+    def get(self, obj_type, ident):
+        # A session which wrote must see its own uncommitted changes
+        cache = None if self.writing else self.objstore.cache
+        if cache is not None:
+            value = cache.get(obj_type, ident)
+            if value is _MISSING:
+                raise NotFoundError(ident)
+            elif value is not None:
+                return value
+            generation = cache.generation(obj_type)
+
+        jsonstr = self.conn.get(obj_type, ident)
+        if jsonstr is None:
+            self._rollback()
+            value = _MISSING
+        else:
+            value = json.loads(jsonstr)
+
+        if cache is not None:
+            cache.put(obj_type, ident, value, generation)
+        if value is _MISSING:
+            raise NotFoundError(ident)
+        return value
+
+    def delete(self, obj_type, ident):
+        self._begin_write()
+        if not self.conn.delete(obj_type, ident):
+            self._rollback()
+            raise NotFoundError(ident)
+        self._dirty.add((obj_type, ident))
+        self._commit()
 
     def store(self, obj_type, ident, data):
-        jsonstr = json.dumps(data)
-        c = self.conn.cursor()
-        c.execute('DELETE FROM objects WHERE type=? AND id=?',
-                  (obj_type, ident))
-        c.execute('INSERT INTO objects (id, type, json) VALUES (?,?,?)',
-                  (ident, obj_type, jsonstr))
-        self.conn.commit()
+        self.store_many(obj_type, [(ident, data)])
+
+    def store_many(self, obj_type, items):
+        """
+        Create or replace several objects with a single commit.  items is
+        a list of (id, data) pairs.  Objects whose data did not change are
+        not written at all.
+        """
+        items = [(ident, data, json.dumps(data, sort_keys=True))
+                 for ident, data in items]
+        # No other writer may change the objects once they are compared
+        self._begin_write()
+        current = self.conn.get_many(obj_type,
+                                     [ident for ident, d, j in items])
+        indexes = self.objstore.indexes
+        changed = [(ident, obj_type, jsonstr,
+                    index_attrs(indexes, obj_type, data))
+                   for ident, data, jsonstr in items
+                   if current.get(ident) != jsonstr]
+        if not changed:
+            return
+
+        self.conn.put_many(changed)
+        self._dirty.update((obj_type, row[0]) for row in changed)
+        self._commit()
+
+    def close(self):
+        if self.writing:
+            self.writing = False
+            self.objstore._write_lock.release()
 
 
 class ObjectStore(object):
-    def __init__(self, location=None):
-        self._lock = threading.Semaphore()
-        self._connections = OrderedDict()
-        self.location = location or config.get_object_store()
-        with self._lock:
-            self._init_db()
+    """
+    A store of JSON objects kept by one of the BACKENDS, sqlite by default.
+    Sessions lease a connection from a pool of at most 'size' connections,
+    waiting up to POOL_TIMEOUT seconds while all of them are in use.  Nested
+    sessions lease their own connection.  An optional ObjectCache saves
+    reading and decoding objects which seldom change.
+    """
+    # Matches the default size of the CherryPy thread pool
+    POOL_SIZE = 10
+    POOL_TIMEOUT = 30
+
+    def __init__(self, location=None, size=None, cache=None, backend=None,
+                 indexes=None):
+        if backend is None or isinstance(backend, basestring):
+            backend = get_backend(backend or 'sqlite', location)
+        self.backend = backend
+        self.indexes = INDEXES if indexes is None else indexes
+        self.size = size or self.POOL_SIZE
+        self.cache = cache
+        self._write_lock = threading.RLock()
+        self._pool = Queue.Queue()
+        self._connections = []
+        self._pool_lock = threading.Lock()
+        self._sessions = threading.local()
+        self._init_db()
 
     def _init_db(self):
         conn = self._get_conn()
-        c = conn.cursor()
-        c.execute('''SELECT * FROM sqlite_master WHERE type='table' AND
-                     tbl_name='objects'; ''')
-        res = c.fetchall()
-        # Because the tasks are regarded as temporary resource, the task states
-        # are purged every time the daemon startup
-        if len(res) == 0:
-            c.execute('''CREATE TABLE objects
-                (id TEXT, type TEXT, json TEXT, PRIMARY KEY (id, type))''')
-            conn.commit()
-            return
-
-        # Clear out expired objects from a previous session
-        c.execute('''DELETE FROM objects WHERE type = 'task'; ''')
-        conn.commit()
+        try:
+            self.backend.setup(conn, self.indexes)
+        finally:
+            self._put_conn(conn)
 
     def _get_conn(self):
-        ident = threading.currentThread().ident
         try:
-            return self._connections[ident]
-        except KeyError:
-            self._connections[ident] = sqlite3.connect(self.location, timeout=10)
-            if len(self._connections.keys()) > 10:
-                id, conn = self._connections.popitem(last=False)
-                conn.interrupt()
-                del conn
-            return self._connections[ident]
+            return self._pool.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self._pool_lock:
+            if len(self._connections) < self.size:
+                conn = self.backend.connect()
+                self._connections.append(conn)
+                return conn
+        # Wait for a session to give back its connection
+        try:
+            return self._pool.get(timeout=self.POOL_TIMEOUT)
+        except Queue.Empty:
+            raise ServiceUnavailable(
+                "No object store connection free after %s seconds" %
+                self.POOL_TIMEOUT)
+
+    def _put_conn(self, conn):
+        self._pool.put(conn)
 
     def __enter__(self):
-        self._lock.acquire()
-        return ObjectStoreSession(self._get_conn())
+        session = ObjectStoreSession(self._get_conn(), self)
+        if not hasattr(self._sessions, 'stack'):
+            self._sessions.stack = []
+        self._sessions.stack.append(session)
+        return session
 
     def __exit__(self, type, value, tb):
-        self._lock.release()
+        session = self._sessions.stack.pop()
+        try:
+            if type is not None:
+                session.conn.rollback()
+            session._dirty.clear()
+        finally:
+            session.close()
+            self._put_conn(session.conn)
@@ -32,6 +32,8 @@ class Root(controller.Resource):
         self.templates = controller.Templates(model)
         self.storagepools = controller.StoragePools(model)
         self.tasks = controller.Tasks(model)
+        self.mosaic = controller.Mosaic(model)
+        self.cachestats = controller.CacheStats(model)
 
     def get(self):
         return self.default('burnet-ui.html')
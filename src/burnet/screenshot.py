@@ -24,8 +24,15 @@
 import os
 import time
 import random
-import uuid
 import glob
+import uuid
+import hashlib
+import io
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 try:
     from PIL import Image
@@ -33,68 +40,415 @@ except ImportError:
     import Image
 
 import config
+from burnet.exception import InvalidParameter, NotFoundError
+from burnet.threadpool import ThreadPool
+
+
+# Thumbnail formats: name -> (PIL format, mime type)
+FORMATS = {'png': ('PNG', 'image/png'),
+           'jpeg': ('JPEG', 'image/jpeg'),
+           'webp': ('WEBP', 'image/webp')}
+
+THUMBNAIL_FORMAT = 'png'
+THUMBNAIL_QUALITY = 75
+MOSAIC_COLUMNS = 10
+
+
+def set_thumbnail_format(fmt, quality=None):
+    """
+    Select the format thumbnails are encoded in.  quality (1-100) applies
+    to the lossy JPEG and WebP formats.
+    """
+    global THUMBNAIL_FORMAT, THUMBNAIL_QUALITY
+    if fmt not in FORMATS:
+        raise InvalidParameter("Unknown screenshot format '%s'" %
+                               fmt)
+    Image.init()
+    if FORMATS[fmt][0] not in Image.SAVE:
+        raise InvalidParameter(
+                    "Screenshot format '%s' not supported by PIL" % fmt)
+    THUMBNAIL_FORMAT = fmt
+    if quality is not None:
+        if not 1 <= quality <= 100:
+            raise InvalidParameter(
+                        "Invalid screenshot quality '%s'" % quality)
+        THUMBNAIL_QUALITY = quality
+
+
+def _encode(image):
+    """
+    Encode an image in the thumbnail format.  Return the data and its mime
+    type.
+    """
+    fmt, mimetype = FORMATS[THUMBNAIL_FORMAT]
+    params = {}
+    if fmt != 'PNG':
+        params['quality'] = THUMBNAIL_QUALITY
+    buf = io.BytesIO()
+    image.save(buf, fmt, **params)
+    return buf.getvalue(), mimetype
+
+
+class ThumbnailCache(object):
+    """
+    A bounded, least recently used map of thumbnail names to their image
+    data, mime type, creation time and entity tag, indexed by VM.  Only
+    superseded thumbnails are evicted, so the newest one of each VM stays
+    even when there are more VMs than room in the cache.
+
+    A janitor thread drops thumbnails older than LIVE_WINDOW every
+    JANITOR_SECS, except the newest one of each VM which is the one in
+    use.  Older ones stay available for a while as they may still be
+    referenced by clients.
+    """
+    SIZE = 256
+    LIVE_WINDOW = 60
+    JANITOR_SECS = 30
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self._thumbnails = OrderedDict()
+        self._index = {}
+        self._lock = threading.Lock()
+        self._janitor = None
+
+    def put(self, name, vm_name, data, mimetype):
+        self._ensure_janitor()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self._lock:
+            self._thumbnails[name] = (vm_name, data, mimetype, time.time(),
+                                      etag)
+            self._index.setdefault(vm_name, OrderedDict())[name] = None
+            excess = len(self._thumbnails) - self.size
+            if excess > 0:
+                for old_name, thumbnail in self._thumbnails.items():
+                    if excess == 0:
+                        break
+                    if old_name == next(reversed(self._index[thumbnail[0]])):
+                        continue
+                    del self._thumbnails[old_name]
+                    self._unindex(old_name, thumbnail[0])
+                    excess -= 1
+
+    def get(self, name):
+        """
+        Return the (data, mimetype, mtime, etag) of a thumbnail.
+        """
+        with self._lock:
+            try:
+                thumbnail = self._thumbnails.pop(name)
+            except KeyError:
+                raise NotFoundError("Screenshot '%s' not found" %
+                                    name)
+            self._thumbnails[name] = thumbnail
+        return thumbnail[1:]
+
+    def delete(self, vm_name):
+        """
+        Drop all thumbnails of a VM.
+        """
+        with self._lock:
+            for name in self._index.pop(vm_name, {}):
+                del self._thumbnails[name]
+
+    def expire(self, window):
+        """
+        Drop thumbnails older than window seconds but the newest of each VM.
+        """
+        now = time.time()
+        with self._lock:
+            for vm_name, names in self._index.items():
+                for name in names.keys()[:-1]:
+                    if now - self._thumbnails[name][3] > window:
+                        del self._thumbnails[name]
+                        self._unindex(name, vm_name)
+
+    def _unindex(self, name, vm_name):
+        names = self._index[vm_name]
+        del names[name]
+        if not names:
+            del self._index[vm_name]
+
+    def _ensure_janitor(self):
+        if self._janitor is not None:
+            return
+        with self._lock:
+            if self._janitor is None:
+                self._janitor = threading.Thread(target=self._run_janitor,
+                                                 name='ThumbnailJanitor')
+                self._janitor.setDaemon(True)
+                self._janitor.start()
+
+    def _run_janitor(self):
+        while True:
+            time.sleep(self.JANITOR_SECS)
+            self.expire(self.LIVE_WINDOW)
+
+
+def reclaim_screenshot_files():
+    """
+    Remove the thumbnail files earlier versions kept in the screenshot
+    directory.  Thumbnails only live in memory now so no file there is
+    referenced any more.
+    """
+    count = 0
+    for path in glob.glob(os.path.join(config.get_screenshot_path(), '*.png')):
+        try:
+            os.unlink(path)
+            count += 1
+        except OSError:
+            pass
+    return count
+
+
+thumbnails = ThumbnailCache()
+# Mosaics are kept apart so that they never push thumbnails out
+mosaics = ThumbnailCache(16)
+
+
+def get_thumbnail(name):
+    """
+    Return the (data, mimetype, mtime, etag) of a thumbnail or mosaic.
+    """
+    try:
+        return thumbnails.get(name)
+    except NotFoundError:
+        return mosaics.get(name)
 
 
 class VMScreenshot(object):
     OUTDATED_SECS = 5
     THUMBNAIL_SIZE = (256, 256)
-    LIVE_WINDOW = 60
 
     def __init__(self, args):
         self.vm_name = args['name']
-        args.setdefault('thumbnail',
-            os.path.join(config.get_screenshot_path(),
-                '%s-%s.png' % (self.vm_name, str(uuid.uuid4()))))
+        args.setdefault('thumbnail', None)
         self.info = args
 
     def lookup(self):
         now = time.time()
         try:
-            last_update = os.path.getmtime(self.info['thumbnail'])
-        except OSError:
+            last_update = thumbnails.get(self.info['thumbnail'])[2]
+        except NotFoundError:
             last_update = 0
 
         if now - last_update > self.OUTDATED_SECS:
-            self._clean_extra(self.LIVE_WINDOW)
-            self._generate_thumbnail()
-        return '/data/screenshots/%s' % os.path.basename(self.info['thumbnail'])
-
+            return self.capture()[0]
+        return self._get_url()
 
-    def _clean_extra(self, window=-1):
+    def capture(self):
         """
-        Clear screenshots before time specified by window,
-        Clear all screenshots if window is -1.
+        Take a new thumbnail now.  Return its URL and a digest of the screen
+        which tells whether it changed since the previous capture.
         """
-        try:
-            now = time.time()
-            clear_list = glob.glob("%s/%s-*.png" %
-                (config.get_screenshot_path(), self.vm_name))
-            for f in clear_list:
-                if now - os.path.getmtime(f) > window:
-                    os.unlink(f)
-        except OSError:
-            pass
+        digest = self._generate_thumbnail()
+        return self._get_url(), digest
+
+    def _get_url(self):
+        return '/data/screenshots/%s' % self.info['thumbnail']
 
     def delete(self):
-        return self._clean_extra()
+        thumbnails.delete(self.vm_name)
 
-    def _generate_scratch(self, thumbnail):
+    def _generate_scratch(self):
         """
-        Generate screenshot of given vm.
+        Return the screenshot of given vm as an encoded image, eg. PPM.
         Override me in child class.
         """
-        pass
+        return ''
 
     def _generate_thumbnail(self):
-        thumbnail = os.path.join(config.get_screenshot_path(), '%s-%s.png' %
-                                 (self.vm_name, str(uuid.uuid4())))
-        self._generate_scratch(thumbnail)
+        scratch = self._generate_scratch()
+        digest = hashlib.md5(scratch).hexdigest()
+        if digest == self.info.get('digest'):
+            try:
+                thumbnails.get(self.info['thumbnail'])
+                # Same screen as last time: keep the thumbnail and its URL
+                return digest
+            except NotFoundError:
+                pass
 
-        if os.path.getsize(thumbnail) == 0:
+        if not scratch:
             image = Image.new("RGB", self.THUMBNAIL_SIZE, 'black')
-            image.save(thumbnail)
         else:
-            im = Image.open(thumbnail)
-            im.thumbnail(self.THUMBNAIL_SIZE)
-            im.save(thumbnail, "PNG")
-        self.info['thumbnail'] = thumbnail
+            image = Image.open(io.BytesIO(scratch))
+            # Decoders which support it (JPEG) decode a reduced size image
+            image.draft('RGB', self.THUMBNAIL_SIZE)
+            image.thumbnail(self.THUMBNAIL_SIZE)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+        data, mimetype = _encode(image)
+        name = '%s-%s.%s' % (self.vm_name, str(uuid.uuid4()), THUMBNAIL_FORMAT)
+        thumbnails.put(name, self.vm_name, data, mimetype)
+        self.info['thumbnail'] = name
+        self.info['digest'] = digest
+        self.info['mtime'] = time.time()
+        return digest
+
+
+def get_mosaic(urls):
+    """
+    Compose thumbnails into one image kept in the thumbnail cache so that
+    clients fetch the screenshots of many VMs in a single request.  urls
+    maps VM names to the URLs of their thumbnails.  Return the URL and
+    size of the mosaic and the position of each VM's thumbnail in it.  The
+    same thumbnails always give the same mosaic URL.
+    """
+    cell_width, cell_height = VMScreenshot.THUMBNAIL_SIZE
+    images = []
+    for vm_name in sorted(urls):
+        name = urls[vm_name].rsplit('/', 1)[-1]
+        try:
+            data = thumbnails.get(name)[0]
+        except NotFoundError:
+            continue
+        # Only reads the image header
+        images.append((vm_name, name, Image.open(io.BytesIO(data))))
+
+    columns = max(1, min(len(images), MOSAIC_COLUMNS))
+    rows = max(1, (len(images) + columns - 1) / columns)
+    size = (columns * cell_width, rows * cell_height)
+    offsets = {}
+    for i, (vm_name, name, image) in enumerate(images):
+        offsets[vm_name] = {'x': (i % columns) * cell_width,
+                            'y': (i / columns) * cell_height,
+                            'width': image.size[0],
+                            'height': image.size[1]}
+
+    key = hashlib.sha1('\0'.join('%s\0%s' % (vm_name, name)
+                                 for vm_name, name, image in images))
+    mosaic_name = 'mosaic-%s.%s' % (key.hexdigest(), THUMBNAIL_FORMAT)
+    try:
+        mosaics.get(mosaic_name)
+    except NotFoundError:
+        mosaic = Image.new("RGB", size, 'black')
+        for vm_name, name, image in images:
+            offset = offsets[vm_name]
+            mosaic.paste(image, (offset['x'], offset['y']))
+
+        data, mimetype = _encode(mosaic)
+        # Mosaics are not owned by any VM
+        mosaics.put(mosaic_name, None, data, mimetype)
+
+    return {'image': '/data/screenshots/%s' % mosaic_name,
+            'width': size[0],
+            'height': size[1],
+            'vms': offsets}
+
+
+class ScreenshotScheduler(object):
+    """
+    Capture thumbnails of running VMs on a bounded pool of workers so that
+    requests only read the latest ready thumbnail.
+
+    capture(name) takes a thumbnail and returns its URL and a digest of the
+    screen.  A VM is captured again once its refresh interval passed.  The
+    interval shrinks while the screen keeps changing and grows while it
+    stays the same, and it is never shorter than the time between two
+    requests for the VM.  VMs nobody asked for in IDLE_SECS are no longer
+    captured.
+    """
+    MIN_INTERVAL = 2
+    INTERVAL = 5
+    MAX_INTERVAL = 60
+    IDLE_SECS = 60
+    FIRST_WAIT = 10
+    WORKERS = 4
+    TICK = 1
+
+    def __init__(self, capture, workers=None):
+        self.capture = capture
+        self.pool = ThreadPool(workers or self.WORKERS, 'Screenshot')
+        self._vms = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self, name, wait=True):
+        """
+        Return the URL of the latest thumbnail of the VM.  Only the first
+        request for a VM waits, up to FIRST_WAIT seconds, for a capture.
+        Without wait None is returned while the first capture is pending.
+        """
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            vm = self._vms.get(name)
+            if vm is None:
+                vm = {'thumbnail': None, 'digest': None, 'error': None,
+                      'job': None, 'captured': 0, 'requested': now,
+                      'request_gap': 0, 'interval': self.INTERVAL}
+                self._vms[name] = vm
+            else:
+                vm['request_gap'] = (vm['request_gap'] +
+                                     now - vm['requested']) / 2
+                vm['requested'] = now
+            if vm['thumbnail'] is None and vm['error'] is None:
+                if vm['job'] is None:
+                    self._submit(name, vm)
+                job = vm['job']
+            else:
+                job = None
+
+        if job is not None and wait:
+            job.wait(self.FIRST_WAIT)
+        with self._lock:
+            if vm['thumbnail'] is not None:
+                return vm['thumbnail']
+            if vm['error'] is not None:
+                raise vm['error']
+        if not wait:
+            return None
+        raise NotFoundError("Screenshot of '%s' not ready" % name)
+
+    def forget(self, name):
+        with self._lock:
+            self._vms.pop(name, None)
+
+    def _interval(self, vm):
+        return max(vm['interval'], min(self.MAX_INTERVAL, vm['request_gap']))
+
+    def _submit(self, name, vm):
+        vm['job'] = self.pool.submit(self._capture, name, vm)
+
+    def _capture(self, name, vm):
+        try:
+            thumbnail, digest = self.capture(name)
+        except Exception, e:
+            with self._lock:
+                # Retry later, the VM may not support screenshots at all
+                vm['error'] = e
+                vm['interval'] = min(self.MAX_INTERVAL, vm['interval'] * 2)
+                vm['captured'] = time.time()
+                vm['job'] = None
+            return
+
+        with self._lock:
+            if digest == vm['digest']:
+                vm['interval'] = min(self.MAX_INTERVAL, vm['interval'] * 2)
+            else:
+                vm['interval'] = max(self.MIN_INTERVAL, vm['interval'] / 2)
+            vm.update({'thumbnail': thumbnail, 'digest': digest,
+                       'error': None, 'captured': time.time(), 'job': None})
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='ScreenshotScheduler')
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.TICK)
+            now = time.time()
+            with self._lock:
+                for name, vm in self._vms.items():
+                    if now - vm['requested'] > self.IDLE_SECS:
+                        del self._vms[name]
+                    elif (vm['job'] is None and
+                          now - vm['captured'] >= self._interval(vm)):
+                        self._submit(name, vm)
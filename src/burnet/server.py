@@ -30,7 +30,10 @@ import logging
 import model
 import mockmodel
 import config
+import controller
+import screenshot
 import cherrypy
+from cherrypy.lib import cptools, httputil
 
 LOGGING_LEVEL = {"debug": logging.DEBUG,
                  "info": logging.INFO,
@@ -51,6 +54,29 @@ def set_no_cache():
     else:
         hList = h
 
+def serve_thumbnail():
+    """
+    Serve screenshot thumbnails from the in-memory cache the way staticdir
+    serves files.
+    """
+    if cherrypy.request.method not in ('GET', 'HEAD'):
+        raise cherrypy.HTTPError(405)
+    name = cherrypy.request.path_info.rsplit('/', 1)[-1]
+    try:
+        data, mimetype, mtime, etag = screenshot.get_thumbnail(name)
+    except model.NotFoundError:
+        raise cherrypy.HTTPError(404)
+    headers = cherrypy.response.headers
+    headers['Content-Type'] = mimetype
+    headers['Last-Modified'] = httputil.HTTPDate(mtime)
+    headers['ETag'] = etag
+    # Let clients keep their copy as long as the screen does not change
+    headers['Cache-Control'] = 'no-cache'
+    cptools.validate_etags()
+    cptools.validate_since()
+    cherrypy.response.body = data
+    cherrypy.request.handler = None
+
 class Server(object):
     CONFIG = {
         '/': { 'tools.trailing_slash.on': False,
@@ -74,13 +100,14 @@ class Server(object):
             'tools.staticdir.dir': 'ui/images',
             'tools.nocache.on': False },
         '/data/screenshots': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': 'data/screenshots',
+            'tools.thumbnails.on': True,
             'tools.nocache.on': False },
         }
 
     def __init__(self, options):
         cherrypy.tools.nocache = cherrypy.Tool('on_end_resource', set_no_cache)
+        cherrypy.tools.thumbnails = cherrypy.Tool('before_handler',
+                                                  serve_thumbnail)
         cherrypy.server.socket_host = options.host
         cherrypy.server.socket_port = options.port
         cherrypy.log.screen = True
@@ -105,12 +132,28 @@ class Server(object):
         # Add rotating log file to cherrypy configuration
         cherrypy.log.error_log.addHandler(h)
 
+        lookup_workers = getattr(options, 'lookup_workers', None)
+        if lookup_workers is not None:
+            controller.set_lookup_workers(lookup_workers)
+
+        screenshot_format = getattr(options, 'screenshot_format', None)
+        if screenshot_format is not None:
+            screenshot.set_thumbnail_format(screenshot_format,
+                                    getattr(options, 'screenshot_quality', None))
+
+        reclaimed = screenshot.reclaim_screenshot_files()
+        if reclaimed:
+            cherrypy.log.error("Removed %i stale screenshot files" % reclaimed)
+
+        objstore_backend = getattr(options, 'objectstore', None) or None
         if hasattr(options, 'model'):
             model_instance = options.model
         elif options.test:
-            model_instance = mockmodel.get_mock_environment()
+            # Test data need not be kept
+            model_instance = mockmodel.get_mock_environment(
+                objstore_backend or 'memory')
         else:
-            model_instance = model.Model()
+            model_instance = model.Model(objstore_backend=objstore_backend)
 
         self.app = cherrypy.tree.mount(Root(model_instance), config=self.CONFIG)
 
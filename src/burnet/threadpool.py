@@ -0,0 +1,98 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sys
+import threading
+import Queue
+
+
+class Job(object):
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exc_info = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def result(self):
+        """
+        Wait for the job and return its value, re-raising any exception
+        raised by the job function.
+        """
+        self.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ThreadPool(object):
+    """
+    A fixed number of daemon worker threads fed from a shared queue.  The
+    workers are started on the first submitted job.
+    """
+    def __init__(self, size, name='ThreadPool'):
+        self.size = size
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                t = threading.Thread(target=self._worker,
+                                     name='%s-%i' % (self.name,
+                                                     len(self._threads)))
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.run()
+
+    def submit(self, fn, *args, **kwargs):
+        if len(self._threads) < self.size:
+            self._start()
+        job = Job(fn, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def map(self, fn, items):
+        """
+        Run fn on every item using the pool workers.  Return the list of
+        finished jobs in the same order as items.
+        """
+        jobs = [self.submit(fn, item) for item in items]
+        for job in jobs:
+            job.wait()
+        return jobs
@@ -103,6 +103,15 @@ class VMTemplate(object):
                     'format': 'qcow2',
                     'path': '%s/%s' % (storage_path, volume)}
 
+            # Disks with a base image are copy-on-write overlays on it
+            backing = ""
+            if 'base_path' in d:
+                backing = """
+              <backingStore>
+                <path>%s</path>
+                <format type='%s'/>
+              </backingStore>""" % (d['base_path'], d['base_format'])
+
             info['xml'] = """
             <volume>
               <name>%(name)s</name>
@@ -111,12 +120,15 @@ class VMTemplate(object):
               <target>
                 <format type='%(format)s'/>
                 <path>%(path)s</path>
-              </target>
+              </target>%(backing)s
             </volume>
-            """ % info
+            """ % dict(info, backing=backing)
             ret.append(info)
         return ret
 
+    def has_base(self):
+        return any('base_path' in d for d in self.info['disks'])
+
     def to_vm_xml(self, vm_name, storage_path):
         params = dict(self.info)
         params['name'] = vm_name
@@ -20,7 +20,19 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import hashlib
+import threading
 import libxml2
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+XPATH_CACHE_SIZE = 256
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
 
 def xpath_get_text(xml, expr):
     doc = libxml2.parseDoc(xml)
@@ -29,3 +41,38 @@ def xpath_get_text(xml, expr):
 
     doc.freeDoc()
     return ret
+
+def xpath_get_multi(xml, exprs, key=None):
+    """
+    Evaluate several XPath expressions with a single parse of xml.  exprs
+    maps names to expressions and the result maps the same names to the
+    list of matching texts.
+
+    When key (eg. the UUID of the object described by xml) is given, the
+    results are remembered for that key and XML document so looking up the
+    same unchanged XML again does not parse it at all.
+    """
+    if key is not None:
+        cache_key = (key, hashlib.sha1(xml).hexdigest(),
+                     tuple(sorted(exprs.iteritems())))
+        with _cache_lock:
+            ret = _cache.pop(cache_key, None)
+            if ret is not None:
+                _cache[cache_key] = ret
+                return dict((k, list(v)) for k, v in ret.iteritems())
+
+    doc = libxml2.parseDoc(xml)
+    try:
+        ret = {}
+        for name, expr in exprs.iteritems():
+            ret[name] = [ str(x.children) for x in doc.xpathEval(expr) ]
+    finally:
+        doc.freeDoc()
+
+    if key is not None:
+        with _cache_lock:
+            _cache[cache_key] = ret
+            while len(_cache) > XPATH_CACHE_SIZE:
+                _cache.popitem(last=False)
+        ret = dict((k, list(v)) for k, v in ret.iteritems())
+    return ret
@@ -0,0 +1,138 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Measure the throughput of the object store backends:
+
+    PYTHONPATH=../src python bench_objectstore.py [--count N] [--dir DIR]
+
+Put DIR on tmpfs to compare with a database in memory.  The read throughput
+is also measured with several threads sharing one store, as the server
+threads do.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import burnet.model
+import burnet.objectstore
+import utils
+
+
+def _timed(fn, count):
+    start = time.time()
+    fn()
+    return count / (time.time() - start)
+
+
+def bench(backend, location, count):
+    utils.remove_objstore(location)
+    store = burnet.objectstore.ObjectStore(location, backend=backend)
+    idents = [str(i) for i in xrange(count)]
+    obj = {'name': 'vm', 'icon': 'images/icon-fedora.png', 'status': 'running',
+           'disks': [{'index': 0, 'size': 10}]}
+    results = {}
+
+    def store_one():
+        # One commit per object, as a request does
+        for ident in idents[:count / 10]:
+            with store as session:
+                session.store('bench', ident, obj)
+
+    def store_many():
+        with store as session:
+            session.store_many('bench', [(ident, dict(obj, id=ident))
+                                         for ident in idents])
+
+    def get():
+        with store as session:
+            for ident in idents:
+                session.get('bench', ident)
+
+    def get_list():
+        for i in xrange(10):
+            with store as session:
+                session.get_all('bench')
+
+    results['store'] = _timed(store_one, count / 10)
+    results['store_many'] = _timed(store_many, count)
+    results['get'] = _timed(get, count)
+    results['get_all'] = _timed(get_list, 10 * count)
+    utils.remove_objstore(location)
+    return results
+
+
+def bench_threads(backend, location, count, nthreads):
+    utils.remove_objstore(location)
+    store = burnet.objectstore.ObjectStore(location, backend=backend)
+    with store as session:
+        session.store_many('bench', [(str(i), {'i': i}) for i in xrange(100)])
+
+    def reader(reads):
+        for i in xrange(reads):
+            with store as session:
+                session.get_all('bench')
+
+    threads = [threading.Thread(target=reader, args=(count / nthreads,))
+               for i in xrange(nthreads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ret = count / (time.time() - start)
+    utils.remove_objstore(location)
+    return ret
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--count', type='int', default=10000,
+                      help="Number of objects")
+    parser.add_option('--dir', help="Where to put the databases")
+    options, args = parser.parse_args(args)
+
+    directory = tempfile.mkdtemp(dir=options.dir)
+    try:
+        location = os.path.join(directory, 'objectstore')
+        columns = ('store', 'store_many', 'get', 'get_all')
+        print '%-8s' % 'objs/s' + ''.join('%12s' % c for c in columns)
+        for backend in sorted(burnet.objectstore.BACKENDS):
+            results = bench(backend, location, options.count)
+            print '%-8s' % backend + ''.join('%12i' % results[c]
+                                             for c in columns)
+
+        threads = (1, 2, 4, 10, 20)
+        print
+        print '%-8s' % 'reads/s' + ''.join('%8i thr' % n for n in threads)
+        for backend in sorted(burnet.objectstore.BACKENDS):
+            print '%-8s' % backend + ''.join(
+                '%12i' % bench_threads(backend, location, options.count / 5, n)
+                for n in threads)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
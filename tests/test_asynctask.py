@@ -0,0 +1,261 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import threading
+import time
+import unittest
+
+import burnet.model
+from burnet.asynctask import AsyncTask, TaskRegistry, TaskScheduler
+from burnet.objectstore import ObjectStore
+
+
+class TaskSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.objstore = ObjectStore(backend='memory')
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.running = set()
+        self.max_running = 0
+
+    def _add(self, scheduler, target_uri='', task_type=None, priority=0,
+             release=None):
+        self.next_id += 1
+        return AsyncTask(self.next_id, target_uri, self._op, self.objstore,
+                         release, scheduler, task_type, priority)
+
+    def _op(self, cb, release):
+        with self.lock:
+            self.running.add(threading.currentThread())
+            self.max_running = max(self.max_running, len(self.running))
+        if release is not None:
+            release.wait(5)
+        else:
+            time.sleep(0.05)
+        with self.lock:
+            self.running.discard(threading.currentThread())
+        cb('done', True)
+
+    def _wait(self, tasks, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if all(self._status(task) != 'running' for task in tasks):
+                return
+            time.sleep(0.02)
+        self.fail('Tasks did not finish')
+
+    def _idle(self, scheduler):
+        while scheduler.stats()['running']:
+            time.sleep(0.01)
+
+    def _status(self, task):
+        with self.objstore as session:
+            return session.get('task', task.id)['status']
+
+    def test_bounded_workers(self):
+        scheduler = TaskScheduler(workers=3)
+        tasks = [self._add(scheduler) for i in xrange(20)]
+        self._wait(tasks)
+        self.assertEquals(3, self.max_running)
+        self.assertEquals(3, len(scheduler._threads))
+        self.assertEquals(['finished'] * 20, map(self._status, tasks))
+
+        self._idle(scheduler)
+        stats = scheduler.stats()
+        self.assertEquals(0, stats['queued'])
+        self.assertEquals(0, stats['running'])
+        self.assertTrue(stats['average_wait'] > 0)
+
+    def test_limits_and_targets(self):
+        scheduler = TaskScheduler(workers=4, limits={'slow': 1})
+        tasks = [self._add(scheduler, task_type='slow') for i in xrange(4)]
+        self._wait(tasks)
+        self.assertEquals(1, self.max_running)
+
+        self.max_running = 0
+        tasks = [self._add(scheduler, target_uri='/vms/a') for i in xrange(4)]
+        tasks += [self._add(scheduler, target_uri='/vms/b')]
+        self._wait(tasks)
+        self.assertEquals(2, self.max_running)
+
+    def test_priority_and_cancel(self):
+        scheduler = TaskScheduler(workers=1)
+        release = threading.Event()
+        first = self._add(scheduler, release=release)
+        while scheduler.stats()['running'] == 0:
+            time.sleep(0.01)
+
+        low = self._add(scheduler, priority=0)
+        high = self._add(scheduler, priority=10)
+        cancelled = self._add(scheduler)
+        self.assertEquals(3, scheduler.stats()['queued'])
+        scheduler.cancel(cancelled.id)
+        self.assertEquals('cancelled', self._status(cancelled))
+
+        release.set()
+        self._wait([first, low, high])
+        self.assertTrue(self._status(high) == self._status(low) == 'finished')
+
+        # A running task stops when it reports
+        release = threading.Event()
+        running = self._add(scheduler, release=release)
+        while scheduler.stats()['running'] == 0:
+            time.sleep(0.01)
+        scheduler.cancel(running.id)
+        release.set()
+        self._wait([running])
+        self.assertEquals('cancelled', self._status(running))
+        self._idle(scheduler)
+        self.assertRaises(burnet.model.InvalidOperation, scheduler.cancel,
+                          running.id)
+
+    def test_priority_order(self):
+        order = []
+
+        def op(cb, name):
+            order.append(name)
+            cb('done', True)
+
+        scheduler = TaskScheduler(workers=1)
+        release = threading.Event()
+        first = self._add(scheduler, release=release)
+        while scheduler.stats()['running'] == 0:
+            time.sleep(0.01)
+        tasks = [AsyncTask(100 + i, '', op, self.objstore, name, scheduler,
+                           None, priority)
+                 for i, (name, priority) in enumerate([('a', 0), ('b', 5),
+                                                       ('c', 0), ('d', 5)])]
+        release.set()
+        self._wait([first] + tasks)
+        self.assertEquals(['b', 'd', 'a', 'c'], order)
+
+    def test_reused_id(self):
+        scheduler = TaskScheduler(workers=2)
+        old_release, release = threading.Event(), threading.Event()
+        self._add(scheduler, release=old_release)
+        # Task ids start over when the model is reset
+        self.next_id = 0
+        task = self._add(scheduler, release=release)
+        while scheduler.stats()['running'] < 2:
+            time.sleep(0.01)
+
+        # The old task ending leaves the new one known to the scheduler
+        old_release.set()
+        while scheduler.stats()['running'] > 1:
+            time.sleep(0.01)
+        scheduler.cancel(task.id)
+        release.set()
+        self._idle(scheduler)
+        self.assertTrue(all(t.isAlive() for t in scheduler._threads))
+
+
+class TaskRegistryTests(unittest.TestCase):
+    def test_coalesced_updates(self):
+        objstore = ObjectStore(backend='memory')
+        registry = TaskRegistry(objstore)
+        step = threading.Event()
+        resume = threading.Event()
+
+        def chatty(cb, opaque):
+            for i in xrange(100):
+                cb('step %i' % i)
+            step.set()
+            resume.wait(5)
+            cb('done', True)
+
+        task = AsyncTask(1, '/vms/a', chatty, objstore, None, None, None, 0,
+                         registry)
+        step.wait(5)
+        self.assertEquals('step 99', registry.lookup(1)['message'])
+        self.assertEquals(['1'], registry.get_list())
+        with objstore as session:
+            self.assertRaises(burnet.model.NotFoundError, session.get,
+                              'task', '1')
+
+        registry.flush()
+        with objstore as session:
+            self.assertEquals('step 99', session.get('task', '1')['message'])
+
+        # Ends are saved at once
+        resume.set()
+        task.thread.join(5)
+        with objstore as session:
+            self.assertEquals('finished', session.get('task', '1')['status'])
+
+    def test_retention(self):
+        objstore = ObjectStore(backend='memory')
+        registry = TaskRegistry(objstore)
+        registry.MAX_ENDED = 2
+
+        class Task(object):
+            target_uri = ''
+            message = 'OK'
+            progress = None
+            results = None
+
+        for i, status in enumerate(['finished', 'failed', 'running',
+                                    'finished']):
+            task = Task()
+            task.id, task.status = str(i), status
+            registry.update(task)
+        registry.flush()
+
+        registry.expire()
+        self.assertEquals(['1', '2', '3'], sorted(registry.get_list()))
+        self.assertRaises(burnet.model.NotFoundError, registry.lookup, 0)
+        with objstore as session:
+            self.assertEquals(['1', '2', '3'],
+                              sorted(session.get_list('task')))
+
+        registry.RETENTION_SECS = 0
+        registry.expire()
+        self.assertEquals(['2'], registry.get_list())
+
+    def test_progress_and_wait(self):
+        objstore = ObjectStore(backend='memory')
+        registry = TaskRegistry(objstore)
+        reported = threading.Event()
+        resume = threading.Event()
+
+        def copy(cb, opaque):
+            time.sleep(0.2)
+            cb('copying', progress={'done': 1, 'total': 2,
+                                    'bytes_done': 100, 'bytes_total': 400})
+            reported.set()
+            resume.wait(5)
+            cb('done', True)
+
+        task = AsyncTask(1, '', copy, objstore, None, None, None, 0, registry)
+        reported.wait(5)
+        progress = registry.lookup(1)['progress']
+        self.assertEquals(25, progress['percent'])
+        self.assertEquals(1, progress['done'])
+        # A quarter took 0.2s so the rest takes about 0.6s
+        self.assertTrue(0 <= progress['eta'] <= 1)
+
+        # Times out while the task runs
+        start = time.time()
+        self.assertEquals('running', registry.lookup(1, wait=0.2)['status'])
+        self.assertTrue(time.time() - start >= 0.2)
+
+        # Returns as soon as it ends
+        threading.Timer(0.2, resume.set).start()
+        start = time.time()
+        self.assertEquals('finished', registry.lookup(1, wait=5)['status'])
+        self.assertTrue(time.time() - start < 2)
@@ -0,0 +1,127 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import threading
+import time
+import unittest
+
+import burnet.model
+from burnet.guard import CircuitBreaker, Guard
+from burnet.guard import get_stale_age, reset_stale_age
+
+
+class Outage(Exception):
+    pass
+
+
+class GuardTests(unittest.TestCase):
+    def setUp(self):
+        reset_stale_age()
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, reset_secs=0.2)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEquals('closed', breaker.state)
+        breaker.failure()
+        self.assertEquals('open', breaker.state)
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.3)
+        self.assertEquals('half-open', breaker.state)
+        # Only one probe is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEquals('open', breaker.state)
+
+        time.sleep(0.3)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEquals('closed', breaker.state)
+        self.assertTrue(breaker.allow())
+
+    def test_deadline_and_stale(self):
+        guard = Guard(timeout=0.2, workers=2)
+        stall = threading.Event()
+
+        def read(value):
+            if stall.isSet():
+                time.sleep(1)
+            return value
+
+        self.assertEquals({'a': 1}, guard.call(read, ({'a': 1},), key='k'))
+        self.assertEquals(None, get_stale_age())
+
+        stall.set()
+        start = time.time()
+        self.assertEquals({'a': 1}, guard.call(read, ({'a': 2},), key='k'))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(get_stale_age() is not None)
+
+        # Nothing cached for this key
+        self.assertRaises(burnet.model.ServiceUnavailable,
+                          guard.call, read, ({'b': 1},), key='other')
+
+    def test_results_bounded(self):
+        guard = Guard(workers=2)
+        guard.RESULTS = 3
+        for name in ('a', 'b', 'c'):
+            guard.call(lambda: name, key=('lookup', name))
+        guard.breaker.allow = lambda: False
+        # A stale read counts as a use and keeps 'a' remembered
+        self.assertEquals('a', guard.call(None, key=('lookup', 'a')))
+        guard.breaker.allow = lambda: True
+        guard.call(lambda: 'd', key=('lookup', 'd'))
+        self.assertEquals(3, len(guard._results))
+        guard.breaker.allow = lambda: False
+        self.assertRaises(burnet.model.ServiceUnavailable, guard.call, None,
+                          key=('lookup', 'b'))
+        self.assertEquals('a', guard.call(None, key=('lookup', 'a')))
+
+        guard.forget('a')
+        self.assertRaises(burnet.model.ServiceUnavailable, guard.call, None,
+                          key=('lookup', 'a'))
+        self.assertEquals(['c', 'd'],
+                          sorted(key[1] for key in guard._results))
+
+    def test_breaker_opens_on_outage(self):
+        calls = []
+
+        def broken():
+            calls.append(1)
+            raise Outage()
+
+        def failed():
+            raise burnet.model.OperationFailed()
+
+        guard = Guard(is_outage=lambda e: isinstance(e, Outage),
+                      breaker=CircuitBreaker(threshold=2, reset_secs=30))
+        # Ordinary errors mean the service is answering
+        for i in xrange(3):
+            self.assertRaises(burnet.model.OperationFailed, guard.call,
+                              failed, deadline=False)
+        self.assertEquals('closed', guard.breaker.state)
+
+        for i in xrange(2):
+            self.assertRaises(Outage, guard.call, broken, deadline=False)
+        self.assertEquals('open', guard.breaker.state)
+        self.assertRaises(burnet.model.ServiceUnavailable, guard.call, broken,
+                          deadline=False)
+        self.assertEquals(2, len(calls))
@@ -26,6 +26,8 @@ import json
 
 import burnet.mockmodel
 import burnet.controller
+import burnet.model
+import burnet.vmtemplate
 
 from utils import *
 
@@ -53,6 +55,61 @@ class MockModelTests(unittest.TestCase):
             else:
                 self.fail("Expected exception not raised")
 
+    def test_collection_with_info(self):
+        class Foo(burnet.controller.Resource):
+            @property
+            def data(self):
+                return {'name': self.ident, 'size': self.info['size']}
+
+        class Foos(burnet.controller.Collection):
+            def __init__(self, model):
+                super(Foos, self).__init__(model)
+                self.resource = Foo
+
+        class FooModel(object):
+            def foos_get_list(self):
+                return ['a', 'b']
+
+            def foos_get_list_with_info(self, fields=None):
+                return [('a', {'size': 1}), ('b', {'size': 2})]
+
+            def foo_lookup(self, name):
+                raise AssertionError("Unexpected lookup of %s" % name)
+
+        c = Foos(FooModel())
+        cherrypy.request.method = 'GET'
+        self.assertEquals([{'name': 'a', 'size': 1}, {'name': 'b', 'size': 2}],
+                          json.loads(c.index()))
+
+    def test_collection_parallel_lookup(self):
+        class Foo(burnet.controller.Resource):
+            @property
+            def data(self):
+                return {'name': self.ident, 'size': self.info['size']}
+
+        class Foos(burnet.controller.Collection):
+            def __init__(self, model):
+                super(Foos, self).__init__(model)
+                self.resource = Foo
+
+        class FooModel(object):
+            def foos_get_list(self):
+                return [str(i) for i in xrange(20)]
+
+            def foo_lookup(self, name):
+                time.sleep(0.1)
+                if name == '5':
+                    raise burnet.model.NotFoundError(name)
+                return {'size': int(name)}
+
+        c = Foos(FooModel())
+        cherrypy.request.method = 'GET'
+        start = time.time()
+        items = json.loads(c.index())
+        self.assertTrue(time.time() - start < 1.5)
+        expected = [{'name': str(i), 'size': i} for i in xrange(20) if i != 5]
+        self.assertEquals(expected, items)
+
     def test_resource(self):
         model = burnet.mockmodel.MockModel()
         r = burnet.controller.Resource(model)
@@ -92,7 +149,7 @@ class MockModelTests(unittest.TestCase):
         rspBody=resp1.read()
         testvm_Data=json.loads(rspBody)
         screenshotURL = testvm_Data['screenshot']
-        time.sleep(5)
+        self.assertEquals('/vms/test-vm/screenshot', screenshotURL)
         resp2 = request(host, port, screenshotURL)
         self.assertEquals(200, resp2.status)
         self.assertEquals(resp2.getheader('content-type'), resp.getheader('content-type'))
@@ -101,6 +158,28 @@ class MockModelTests(unittest.TestCase):
 
         test_server.stop()
 
+    def test_template_capture_rollback(self):
+        model = burnet.mockmodel.MockModel()
+        model.templates_create({'name': 'test'})
+        model.vms_create({'name': u'test-vm', 'template': '/templates/test'})
+
+        def broken(params, scan=False):
+            raise burnet.model.OperationFailed()
+        orig = burnet.vmtemplate.VMTemplate
+        burnet.vmtemplate.VMTemplate = broken
+        try:
+            self.assertRaises(burnet.model.OperationFailed,
+                              model.templates_create,
+                              {'name': 'captured', 'vm': '/vms/test-vm'})
+        finally:
+            burnet.vmtemplate.VMTemplate = orig
+        # The copied disks are gone and the name is free again
+        self.assertFalse('captured-base-0.img' in
+                         model.storagevolumes_get_list('default'))
+        model.templates_create({'name': 'captured', 'vm': '/vms/test-vm'})
+        self.assertTrue('captured-base-0.img' in
+                        model.storagevolumes_get_list('default'))
+
     def test_vm_list_sorted(self):
         model = burnet.mockmodel.MockModel()
         port = get_free_port()
@@ -24,9 +24,14 @@ import unittest
 import threading
 import os
 import time
+import json
+import sqlite3
+
+import libvirt
 
 import burnet.model
 import burnet.objectstore
+from burnet.xmlutils import xpath_get_text
 import utils
 
 class ModelTests(unittest.TestCase):
@@ -34,7 +39,7 @@ class ModelTests(unittest.TestCase):
         self.tmp_store = '/tmp/burnet-store-test'
 
     def tearDown(self):
-        os.unlink(self.tmp_store)
+        utils.remove_objstore(self.tmp_store)
 
     def test_vm_info(self):
         inst = burnet.model.Model('test:///default', self.tmp_store)
@@ -52,6 +57,101 @@ class ModelTests(unittest.TestCase):
         self.assertRaises(burnet.model.NotFoundError,
                           inst.vm_lookup, 'nosuchvm')
 
+    def test_vms_info_sweep(self):
+        inst = burnet.model.Model('test:///default', self.tmp_store)
+        vms_info = burnet.model._get_vms_info(inst.conn.get())
+        self.assertEquals(['test'], [dom.name() for dom, info in vms_info])
+
+        dom, info = vms_info[0]
+        self.assertEquals(dom.info()[:4], list(info[:4]))
+
+    def test_vm_inventory(self):
+        inst = burnet.model.Model('test:///default', self.tmp_store)
+        vms = inst.inventory.get_all()
+        self.assertEquals(['test'], [vm['name'] for vm in vms])
+
+        vm = inst.inventory.get('test')
+        state_map = burnet.model.Model.dom_state_map
+        self.assertEquals('running', state_map[vm['state']])
+        self.assertEquals(2, vm['vcpus'])
+        self.assertEquals(36, len(vm['uuid']))
+        self.assertRaises(burnet.model.NotFoundError,
+                          inst.inventory.get, 'nosuchvm')
+
+        inst.vm_stop('test')
+        self.assertEquals('shutoff', inst.vm_lookup('test')['state'])
+        inst.vm_start('test')
+        self.assertEquals('running', inst.vm_lookup('test')['state'])
+
+        # A full reconcile drops domains which disappeared without an event
+        inst.inventory._vms['ghost'] = dict(vm, name='ghost')
+        inst.inventory.reconcile()
+        self.assertEquals(['test'], inst.vms_get_list())
+
+    def test_vm_inventory_errors(self):
+        inst = burnet.model.Model('test:///default', self.tmp_store)
+        inventory = inst.inventory
+        inventory.get_all()
+        conn = inventory._conn
+        closed = []
+        close = conn.close
+        conn.close = lambda: closed.append(close())
+
+        errors = [KeyError('test'), libvirt.libvirtError('Broken')]
+        def broken(name):
+            raise errors.pop(0)
+        inventory.refresh = broken
+        for error in list(errors):
+            inventory._pending.put('test')
+        for i in xrange(50):
+            if inventory._conn is None:
+                break
+            time.sleep(0.1)
+        del inventory.refresh
+
+        # The thread goes on and the broken connection was closed
+        self.assertTrue(inventory._thread.isAlive())
+        self.assertEquals(1, len(closed))
+        inventory.refresh('test')
+        self.assertTrue(inventory._conn not in (None, conn))
+
+    def test_vms_get_list_with_info(self):
+        inst = burnet.model.Model('test:///default', self.tmp_store)
+        with inst.objstore as session:
+            session.store('vm', 'test', {'icon': 'images/icon-test.png'})
+
+        vms = inst.vms_get_list_with_info()
+        self.assertEquals(['test'], [name for name, info in vms])
+        name, info = vms[0]
+        lookup = inst.vm_lookup('test')
+        for key in ('state', 'memory', 'icon', 'vnc_port'):
+            self.assertEquals(lookup[key], info[key])
+        self.assertEquals('images/icon-test.png', info['icon'])
+
+        # Fields the request does not need are skipped
+        name, info = inst.vms_get_list_with_info(fields=['name', 'state'])[0]
+        self.assertEquals('running', info['state'])
+        self.assertEquals((None, None), (info['icon'], info['cpu_stats']))
+
+    def test_get_list_with_info_fields(self):
+        inst = burnet.model.Model('test:///default', self.tmp_store)
+        pools = inst.storagepools_get_list_with_info(fields=['name', 'state'])
+        self.assertEquals(['default-pool'], [name for name, info in pools])
+        self.assertEquals('active', pools[0][1]['state'])
+        # Answered from the remembered result while libvirtd is unavailable
+        inst.guard.breaker.allow = lambda: False
+        self.assertEquals(pools, inst.storagepools_get_list_with_info(
+            fields=['state', 'name']))
+        self.assertRaises(burnet.model.ServiceUnavailable,
+                          inst.storagepools_get_list_with_info,
+                          fields=[{'unhashable': True}])
+        inst.guard.breaker.allow = lambda: True
+
+        vols = inst.storagevolumes_get_list_with_info('default-pool',
+                                                      fields=['name'])
+        self.assertEquals(inst.storagevolumes_get_list('default-pool'),
+                          [name for name, info in vols])
+
     @unittest.skipUnless(utils.running_as_root(), 'Must be run as root')
     def test_vm_lifecycle(self):
         inst = burnet.model.Model(objstore_loc=self.tmp_store)
@@ -77,6 +177,41 @@ class ModelTests(unittest.TestCase):
         vms = inst.vms_get_list()
         self.assertFalse('burnet-vm' in vms)
 
+    @unittest.skipUnless(utils.running_as_root(), 'Must be run as root')
+    def test_vm_base_image(self):
+        inst = burnet.model.Model(objstore_loc=self.tmp_store)
+
+        with utils.RollbackContext() as rollback:
+            params = {'name': 'test-base.img', 'capacity': 1024,
+                      'format': 'qcow2'}
+            inst.storagevolumes_create('default', params)
+            rollback.prependDefer(inst.storagevolume_delete, 'default',
+                                  'test-base.img')
+
+            base = '/storagepools/default/storagevolumes/test-base.img'
+            params = {'name': 'test', 'disks': [{'base': base}]}
+            inst.templates_create(params)
+            rollback.prependDefer(inst.template_delete, 'test')
+            disk = inst.template_lookup('test')['disks'][0]
+            self.assertEquals(1, disk['size'])
+            self.assertEquals('/var/lib/libvirt/images/test-base.img',
+                              disk['base_path'])
+
+            params = {'name': 'test-vm-1', 'template': '/templates/test'}
+            inst.vms_create(params)
+            rollback.prependDefer(inst.vm_delete, 'test-vm-1')
+
+            xml = inst.conn.get().storageVolLookupByPath(
+                '/var/lib/libvirt/images/test-vm-1-0.img').XMLDesc(0)
+            backing = xpath_get_text(xml, '/volume/backingStore/path')
+            self.assertEquals(['/var/lib/libvirt/images/test-base.img'],
+                              backing)
+            self.assertRaises(burnet.model.InvalidOperation,
+                              inst.template_delete, 'test')
+            self.assertRaises(burnet.model.InvalidOperation,
+                              inst.storagevolume_delete, 'default',
+                              'test-base.img')
+
     @unittest.skipUnless(utils.running_as_root(), 'Must be run as root')
     def test_vm_storage_provisioning(self):
         inst = burnet.model.Model(objstore_loc=self.tmp_store)
@@ -190,6 +325,52 @@ class ModelTests(unittest.TestCase):
         for t in threads:
             t.join()
 
+    def test_connection_pool(self):
+        def worker():
+            conns.append(pool.get())
+
+        pool = burnet.model.LibvirtConnection('test:///default', 2)
+        conns = []
+        threads = []
+        for i in xrange(4):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.assertEquals(2, len(set(conns)))
+
+        # The connection leased to a thread is stable while it is healthy
+        conn = pool.get()
+        self.assertTrue(conn is pool.get())
+
+        # A dead connection is replaced on the next lease
+        conn.close()
+        self.assertFalse(conn is pool.get())
+        self.assertEquals(['test'],
+                          [dom.name() for dom in pool.get().listAllDomains(0)])
+
+        # A health check failing because libvirtd went away reconnects
+        def dead():
+            raise burnet.model.libvirt.libvirtError('libvirtd went away')
+
+        slot = pool._get_slot()
+        conn = pool.get()
+        conn.isAlive = dead
+        pool._wrap(conn, slot)
+        is_connection_error = burnet.model._is_connection_error
+        burnet.model._is_connection_error = lambda e: True
+        try:
+            conns = []
+            t = threading.Thread(target=lambda: conns.append(pool.get(slot)))
+            t.setDaemon(True)
+            t.start()
+            t.join(5)
+            self.assertFalse(t.isAlive())
+        finally:
+            burnet.model._is_connection_error = is_connection_error
+        self.assertFalse(conn is conns[0])
+
     def test_object_store(self):
         store = burnet.objectstore.ObjectStore(self.tmp_store)
 
@@ -207,6 +388,10 @@ class ModelTests(unittest.TestCase):
             item = session.get('foo', 'test1')
             self.assertEquals(1, item['a'])
 
+            # Test get all
+            items = dict(session.get_all('foo'))
+            self.assertEquals({'test1': {'a': 1}, 'test2': {'b': 2}}, items)
+
             # Test delete
             session.delete('foo', 'test2')
             self.assertEquals(1, len(session.get_list('foo')))
@@ -224,6 +409,187 @@ class ModelTests(unittest.TestCase):
             item = session.get('foo', 'test1')
             self.assertEquals(2, item['a'])
 
+    def test_object_store_bulk(self):
+        store = burnet.objectstore.ObjectStore(self.tmp_store)
+
+        with store as session:
+            items = [(str(i), {'i': i}) for i in xrange(1200)]
+            session.store_many('foo', items)
+            self.assertEquals(1200, len(session.get_list('foo')))
+
+            ids = ['5', 'missing', '1100', '0']
+            self.assertEquals([('5', {'i': 5}), ('1100', {'i': 1100}),
+                               ('0', {'i': 0})], session.get_many('foo', ids))
+            self.assertEquals(1200, len(session.get_many('foo',
+                                        [str(i) for i in xrange(1200)])))
+
+            # Unchanged objects are not written again
+            changes = session.conn.db.total_changes
+            session.store('foo', '5', {'i': 5})
+            session.store_many('foo', items[:10])
+            self.assertEquals(changes, session.conn.db.total_changes)
+            session.store('foo', '5', {'i': 6})
+            self.assertEquals(changes + 1, session.conn.db.total_changes)
+
+            # A failed transaction leaves nothing behind
+            try:
+                with session.transaction():
+                    session.store('foo', 'new', {})
+                    session.delete('foo', '0')
+                    session.delete('foo', 'missing')
+            except burnet.model.NotFoundError:
+                pass
+            self.assertRaises(burnet.model.NotFoundError, session.get,
+                              'foo', 'new')
+            self.assertEquals({'i': 0}, session.get('foo', '0'))
+
+            with session.transaction():
+                session.store('foo', 'new', {})
+                session.delete('foo', '0')
+        with store as session:
+            self.assertEquals({}, session.get('foo', 'new'))
+            self.assertRaises(burnet.model.NotFoundError, session.get,
+                              'foo', '0')
+
+    def test_object_store_backends(self):
+        for backend in sorted(burnet.objectstore.BACKENDS):
+            utils.remove_objstore(self.tmp_store)
+            store = burnet.objectstore.ObjectStore(self.tmp_store,
+                                                   backend=backend)
+            with store as session:
+                session.store_many('foo', [('a', {'v': 1}), ('b', {'v': 2})])
+                session.delete('foo', 'b')
+                self.assertRaises(burnet.model.NotFoundError,
+                                  session.delete, 'foo', 'b')
+                self.assertEquals([('a', {'v': 1})], session.get_all('foo'))
+
+            # Uncommitted writes are only seen by their session
+            with store as writer:
+                with writer.transaction():
+                    writer.store('foo', 'c', {})
+                    self.assertEquals({}, writer.get('foo', 'c'))
+                    with store as reader:
+                        self.assertEquals(['a'], reader.get_list('foo'))
+                        self.assertEquals([], reader.get_many('foo', ['c']))
+                with store as reader:
+                    self.assertEquals({}, reader.get('foo', 'c'))
+
+            with store as session:
+                try:
+                    with session.transaction():
+                        session.delete('foo', 'a')
+                        raise ValueError()
+                except ValueError:
+                    pass
+                self.assertEquals({'v': 1}, session.get('foo', 'a'))
+
+        self.assertRaises(burnet.model.InvalidParameter,
+                          burnet.objectstore.ObjectStore, self.tmp_store,
+                          backend='unknown')
+
+    def test_object_store_filters(self):
+        for backend in ('sqlite', 'memory'):
+            utils.remove_objstore(self.tmp_store)
+            store = burnet.objectstore.ObjectStore(self.tmp_store,
+                                                   backend=backend)
+            with store as session:
+                session.store_many('task', [
+                    ('1', {'status': 'running', 'target_uri': '/vms/a'}),
+                    ('2', {'status': 'finished', 'target_uri': '/vms/a'}),
+                    ('3', {'status': 'running', 'target_uri': '/vms/b'})])
+                session.store_many('screenshot', [('a', {'mtime': 10}),
+                                                  ('b', {'mtime': 20})])
+
+                self.assertEquals(['1', '3'], sorted(
+                    session.get_list('task', status='running')))
+                self.assertEquals([('1', {'status': 'running',
+                                          'target_uri': '/vms/a'})],
+                                  session.get_all('task', status='running',
+                                                  target_uri='/vms/a'))
+                self.assertEquals(['b'], session.get_list('screenshot',
+                                                          mtime=('>', 15)))
+                # Attributes without an index are filtered after reading
+                session.store('screenshot', 'b', {'mtime': 20, 'size': 1})
+                self.assertEquals(['b'], session.get_list('screenshot',
+                                                          size=1))
+
+                session.store('task', '1', {'status': 'finished'})
+                session.delete('task', '3')
+                self.assertEquals([], session.get_list('task',
+                                                       status='running'))
+                self.assertRaises(burnet.model.InvalidParameter,
+                                  session.get_list, 'task',
+                                  status=('like', 'r%'))
+
+    def test_object_store_migration(self):
+        # A database from before the schema was versioned
+        conn = sqlite3.connect(self.tmp_store)
+        conn.execute('CREATE TABLE objects '
+                     '(id TEXT, type TEXT, json TEXT, PRIMARY KEY (id, type))')
+        conn.execute("INSERT INTO objects VALUES ('vm1', 'vm', ?)",
+                     (json.dumps({'template': 't1'}),))
+        conn.commit()
+        conn.close()
+
+        store = burnet.objectstore.ObjectStore(self.tmp_store)
+        with store as session:
+            self.assertEquals(['vm1'], session.get_list('vm', template='t1'))
+            version = session.conn.db.execute('PRAGMA user_version')
+            self.assertEquals(2, version.fetchone()[0])
+
+        # Indexes are rebuilt when their definition changes
+        store = burnet.objectstore.ObjectStore(self.tmp_store,
+                                               indexes={'vm': ('icon',)})
+        with store as session:
+            session.store('vm', 'vm2', {'icon': 'i'})
+            rows = session.conn.db.execute('SELECT attr FROM object_index')
+            self.assertEquals([('icon',)], rows.fetchall())
+
+    def test_object_store_cache(self):
+        cache = burnet.objectstore.ObjectCache({'foo': 0.5}, size=2)
+        store = burnet.objectstore.ObjectStore(self.tmp_store, cache=cache)
+
+        with store as session:
+            session.store('foo', 'a', {'v': 1})
+            session.store('bar', 'a', {'v': 1})
+        with store as session:
+            for i in xrange(3):
+                self.assertEquals({'v': 1}, session.get('foo', 'a'))
+                self.assertEquals({'v': 1}, session.get('bar', 'a'))
+                self.assertRaises(burnet.model.NotFoundError, session.get,
+                                  'foo', 'none')
+        # Only 'foo' objects are cached, missing ones too
+        self.assertEquals(4, cache.hits)
+        self.assertEquals(2, cache.misses)
+
+        # Writes invalidate the entries once committed
+        with store as session:
+            with session.transaction():
+                session.store('foo', 'a', {'v': 2})
+                session.store('foo', 'none', {})
+            self.assertEquals({'v': 2}, session.get('foo', 'a'))
+        with store as session:
+            self.assertEquals({'v': 2}, session.get('foo', 'a'))
+            self.assertEquals({}, session.get('foo', 'none'))
+            session.delete('foo', 'none')
+        with store as session:
+            self.assertRaises(burnet.model.NotFoundError, session.get,
+                              'foo', 'none')
+
+        # Entries expire and the least recently used are evicted
+        with store as session:
+            session.store('foo', 'b', {})
+            session.store('foo', 'c', {})
+        with store as session:
+            for ident in 'abc':
+                session.get('foo', ident)
+        self.assertEquals(2, cache.stats()['entries'])
+        time.sleep(0.6)
+        misses = cache.misses
+        with store as session:
+            session.get('foo', 'c')
+        self.assertEquals(misses + 1, cache.misses)
+
     def test_object_store_threaded(self):
         def worker(ident):
             with store as session:
@@ -241,7 +607,86 @@ class ModelTests(unittest.TestCase):
             t.join()
         with store as session:
             self.assertEquals(50, len(session.get_list('foo')))
-            self.assertEquals(10, len(store._connections.keys()))
+            self.assertTrue(len(store._connections) <= store.POOL_SIZE)
+
+    def test_object_store_concurrency(self):
+        store = burnet.objectstore.ObjectStore(self.tmp_store)
+        with store as session:
+            for i in xrange(100):
+                session.store('foo', str(i), {'i': i})
+
+        # A session in the middle of writing does not block readers
+        writing = threading.Event()
+        done = threading.Event()
+
+        def writer():
+            with store as session:
+                session.store('foo', 'w', {})
+                writing.set()
+                done.wait(5)
+
+        t = threading.Thread(target=writer)
+        t.setDaemon(True)
+        t.start()
+        writing.wait(5)
+        with store as session:
+            self.assertEquals(101, len(session.get_list('foo')))
+        done.set()
+        t.join()
+
+        # Concurrent sessions never open more connections than the pool size
+        def reader():
+            for i in xrange(5):
+                with store as session:
+                    session.get_all('foo')
+
+        threads = [threading.Thread(target=reader) for i in xrange(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(len(store._connections) <= store.POOL_SIZE)
+
+    def test_object_store_nested(self):
+        store = burnet.objectstore.ObjectStore(self.tmp_store, size=2)
+        store.POOL_TIMEOUT = 0.1
+        # Nested sessions may write on the same thread
+        with store as outer:
+            outer.store('foo', 'a', {})
+            with store as inner:
+                inner.store('foo', 'b', {})
+                # Waiting for a connection gives up when none is given back
+                self.assertRaises(burnet.model.ServiceUnavailable,
+                                  store.__enter__)
+            self.assertEquals(['a', 'b'], sorted(outer.get_list('foo')))
+
+    def test_object_store_compare_locked(self):
+        store = burnet.objectstore.ObjectStore(self.tmp_store)
+        with store as session:
+            session.store('foo', 'a', {'v': 1})
+
+        def write():
+            with store as session:
+                session.store('foo', 'a', {'v': 2})
+        writers = []
+        with store as session:
+            get_many = session.conn.get_many
+
+            def racing_get_many(*args):
+                # Another writer waits until the comparison is done
+                t = threading.Thread(target=write)
+                t.start()
+                t.join(0.2)
+                writers.append((t, t.isAlive()))
+                return get_many(*args)
+            session.conn.get_many = racing_get_many
+            session.store('foo', 'a', {'v': 1})
+            del session.conn.get_many
+        t, blocked = writers[0]
+        self.assertTrue(blocked)
+        t.join()
+        with store as session:
+            self.assertEquals({'v': 2}, session.get('foo', 'a'))
 
     def test_async_tasks(self):
         class task_except(Exception):
@@ -24,8 +24,10 @@ import unittest
 import json
 import time
 import os
+import threading
 
 import burnet.mockmodel
+import burnet.objectstore
 import burnet.server
 from utils import *
 from burnet.asynctask import AsyncTask
@@ -49,7 +51,7 @@ def setUpModule():
 
 def tearDownModule():
     test_server.stop()
-    os.unlink('/tmp/obj-store-test')
+    remove_objstore('/tmp/obj-store-test')
 
 
 class RestTests(unittest.TestCase):
@@ -168,6 +170,122 @@ class RestTests(unittest.TestCase):
         self.assertEquals('vm-1', vm['name'])
         self.assertEquals('shutoff', vm['state'])
 
+    def test_get_vms_query(self):
+        req = json.dumps({'name': 'test'})
+        resp = request(host, port, '/templates', req, 'POST')
+        self.assertEquals(201, resp.status)
+
+        for i in xrange(10):
+            name = 'vm-%i' % i
+            req = json.dumps({'name': name, 'template': '/templates/test'})
+            resp = request(host, port, '/vms', req, 'POST')
+            self.assertEquals(201, resp.status)
+        for name in ('vm-2', 'vm-5'):
+            request(host, port, '/vms/%s/start' % name, '{}', 'POST')
+
+        vms = json.loads(request(host, port, '/vms?limit=3&offset=2').read())
+        self.assertEquals(['vm-2', 'vm-3', 'vm-4'], [vm['name'] for vm in vms])
+
+        vms = json.loads(request(host, port, '/vms?state=running').read())
+        self.assertEquals(['vm-2', 'vm-5'], [vm['name'] for vm in vms])
+
+        vms = json.loads(request(host, port,
+                                 '/vms?state=running&offset=1').read())
+        self.assertEquals(['vm-5'], [vm['name'] for vm in vms])
+
+        vms = json.loads(request(host, port, '/vms?name=vm-1&name=vm-7'
+                                             '&fields=name,state').read())
+        self.assertEquals([{'name': 'vm-1', 'state': 'shutoff'},
+                           {'name': 'vm-7', 'state': 'shutoff'}], vms)
+
+        self.assertHTTPStatus(400, host, port, '/vms?limit=-1')
+        self.assertHTTPStatus(400, host, port, '/vms?offset=x')
+
+    def test_vm_create_async(self):
+        req = json.dumps({'name': 'test', 'disks': [{'size': 1}, {'size': 2}]})
+        resp = request(host, port, '/templates', req, 'POST')
+        self.assertEquals(201, resp.status)
+
+        req = json.dumps({'name': 'test-vm', 'template': '/templates/test',
+                          'async': True})
+        resp = request(host, port, '/vms', req, 'POST')
+        self.assertEquals(202, resp.status)
+        task = json.loads(resp.read())
+        self.assertEquals('/tasks/%s' % task['id'],
+                          resp.getheader('location'))
+
+        # The name is taken while the VM is being created
+        resp = request(host, port, '/vms', req, 'POST')
+        self.assertEquals(400, resp.status)
+
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % task['id']).read())
+        self.assertEquals('finished', task['status'])
+        self.assertEquals(100, task['progress']['percent'])
+        vm = json.loads(request(host, port, '/vms/test-vm').read())
+        self.assertEquals('shutoff', vm['state'])
+
+        # A failure removes the disks created so far
+        model.storagevolumes_create('default', {'name': 'test-vm2-1.img',
+                                                'capacity': 1, 'type': 'disk',
+                                                'format': 'qcow2'})
+        req = json.dumps({'name': 'test-vm2', 'template': '/templates/test',
+                          'async': True})
+        task = json.loads(request(host, port, '/vms', req, 'POST').read())
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % task['id']).read())
+        self.assertEquals('failed', task['status'])
+        self.assertHTTPStatus(404, host, port, '/vms/test-vm2')
+        self.assertHTTPStatus(404, host, port, '/storagepools/default/'
+                              'storagevolumes/test-vm2-0.img')
+
+    def test_vm_create_bulk(self):
+        req = json.dumps({'name': 'test', 'disks': [{'size': 1}]})
+        resp = request(host, port, '/templates', req, 'POST')
+        self.assertEquals(201, resp.status)
+        model.vms_create({'name': u'test-vm-2',
+                          'template': '/templates/test'})
+
+        # Names are chosen around the existing VMs
+        req = json.dumps({'template': '/templates/test', 'count': 3})
+        resp = request(host, port, '/vms', req, 'POST')
+        self.assertEquals(202, resp.status)
+        task = json.loads(resp.read())
+        self.assertEquals('/tasks/%s' % task['id'],
+                          resp.getheader('location'))
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % task['id']).read())
+        self.assertEquals('finished', task['status'])
+        self.assertEquals(['test-vm-1', 'test-vm-3', 'test-vm-4'],
+                          [r['name'] for r in task['results']])
+        self.assertEquals(['finished'] * 3,
+                          [r['status'] for r in task['results']])
+        vms = json.loads(request(host, port, '/vms').read())
+        self.assertEquals(4, len(vms))
+
+        # Each VM gets its own result
+        model.storagevolumes_create('default', {'name': 'b-0.img',
+                                                'capacity': 1, 'type': 'disk',
+                                                'format': 'qcow2'})
+        req = json.dumps({'template': '/templates/test',
+                          'names': ['a', 'b', 'c']})
+        task = json.loads(request(host, port, '/vms', req, 'POST').read())
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % task['id']).read())
+        self.assertEquals('failed', task['status'])
+        self.assertEquals('Created 2 of 3 VMs', task['message'])
+        self.assertEquals(['finished', 'failed', 'finished'],
+                          [r['status'] for r in task['results']])
+        self.assertHTTPStatus(404, host, port, '/vms/b')
+
+        # Bad counts, names and names in use are refused at once
+        for params in ({'count': 0}, {'count': 'many'}, {'names': []},
+                       {'names': ['d', 'd']}, {'names': ['d'], 'count': 1},
+                       {'names': ['a']}):
+            params['template'] = '/templates/test'
+            resp = request(host, port, '/vms', json.dumps(params), 'POST')
+            self.assertEquals(400, resp.status)
+
     def test_vm_lifecycle(self):
         # Create a Template
         req = json.dumps({'name': 'test', 'disks': [{'size': 1}],
@@ -280,6 +398,11 @@ class RestTests(unittest.TestCase):
         storagepools = json.loads(request(host, port, '/storagepools').read())
         self.assertEquals(6, len(storagepools))
 
+        storagepools = json.loads(request(host, port,
+                                  '/storagepools?limit=2&fields=name').read())
+        self.assertEquals(2, len(storagepools))
+        self.assertEquals(['name'], storagepools[0].keys())
+
         storagepool = json.loads(request(host, port,
                                 '/storagepools/storagepool-1').read())
         self.assertEquals('storagepool-1', storagepool['name'])
@@ -432,6 +555,62 @@ class RestTests(unittest.TestCase):
         resp = request(host, port, '/templates/test', '{}', 'DELETE')
         self.assertEquals(204, resp.status)
 
+    def test_template_base_image(self):
+        req = json.dumps({'name': 'golden.img', 'capacity': 2048,
+                          'type': 'disk', 'format': 'raw'})
+        resp = request(host, port, '/storagepools/default/storagevolumes',
+                       req, 'POST')
+        self.assertEquals(201, resp.status)
+
+        # Disks take the size of their base image
+        base = '/storagepools/default/storagevolumes/golden.img'
+        req = json.dumps({'name': 'test', 'disks': [{'base': base}]})
+        resp = request(host, port, '/templates', req, 'POST')
+        self.assertEquals(201, resp.status)
+        t = json.loads(request(host, port, '/templates/test').read())
+        self.assertEquals(2, t['disks'][0]['size'])
+        self.assertEquals('raw', t['disks'][0]['base_format'])
+        for disk in ({'base': base, 'size': 1},
+                     {'base': '/storagepools/default/storagevolumes/none'}):
+            req = json.dumps({'name': 'bad', 'disks': [disk]})
+            resp = request(host, port, '/templates', req, 'POST')
+            self.assertEquals(400, resp.status)
+
+        # The template stays while a VM uses its base image
+        req = json.dumps({'name': 'test-vm', 'template': '/templates/test'})
+        resp = request(host, port, '/vms', req, 'POST')
+        self.assertEquals(201, resp.status)
+        self.assertHTTPStatus(400, host, port, '/templates/test', '{}',
+                              'DELETE')
+        self.assertHTTPStatus(400, host, port, base, '{}', 'DELETE')
+
+        # Capture a shut off VM
+        req = json.dumps({'name': 'captured', 'vm': '/vms/test-vm'})
+        resp = request(host, port, '/templates', req, 'POST')
+        self.assertEquals(201, resp.status)
+        t = json.loads(request(host, port, '/templates/captured').read())
+        self.assertEquals('/storagepools/default/storagevolumes/'
+                          'captured-base-0.img', t['disks'][0]['base'])
+        self.assertHTTPStatus(200, host, port, t['disks'][0]['base'])
+
+        # Flatten the running VM
+        self.assertHTTPStatus(400, host, port, '/vms/test-vm/flatten', '{}',
+                              'POST')
+        request(host, port, '/vms/test-vm/start', '{}', 'POST')
+        req = json.dumps({'name': 'test', 'vm': '/vms/test-vm'})
+        self.assertHTTPStatus(400, host, port, '/templates', req, 'POST')
+        resp = request(host, port, '/vms/test-vm/flatten', '{}', 'POST')
+        self.assertEquals(202, resp.status)
+        task = json.loads(resp.read())
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % task['id']).read())
+        self.assertEquals('finished', task['status'])
+        self.assertHTTPStatus(400, host, port, '/vms/test-vm/flatten', '{}',
+                              'POST')
+        self.assertHTTPStatus(204, host, port, '/templates/test', '{}',
+                              'DELETE')
+        self.assertHTTPStatus(204, host, port, base, '{}', 'DELETE')
+
     def test_screenshot_refresh(self):
         # Create a VM
         req = json.dumps({'name': 'test'})
@@ -462,10 +641,64 @@ class RestTests(unittest.TestCase):
         lastMod2 = resp.getheader('last-modified')
         self.assertEquals(lastMod2, lastMod1)
 
+        # Clients keep their copy while the screenshot does not change
+        etag = resp.getheader('etag')
+        resp = request(host, port, '/vms/test-vm/screenshot',
+                       headers={'If-None-Match': etag})
+        self.assertEquals(304, resp.status)
+
 
         resp = request(host, port, '/vms/test-vm/screenshot', '{}', 'DELETE')
         self.assertEquals(405, resp.status)
 
+        # All screenshots in one image
+        mosaic = json.loads(request(host, port, '/mosaic?vms=test-vm').read())
+        self.assertEquals(['test-vm'], mosaic['vms'].keys())
+        resp = request(host, port, mosaic['image'])
+        self.assertEquals(200, resp.status)
+        self.assertEquals('image/png', resp.getheader('content-type'))
+
+        # Concurrent requests get the mosaic of their own selection
+        rendering, finished = threading.Event(), threading.Event()
+
+        class Paused(dict):
+            # Hold the request while it renders, until the other one ended
+            def __getitem__(self, key):
+                rendering.set()
+                finished.wait(5)
+                return dict.__getitem__(self, key)
+
+        def lookup(names=None):
+            info = {'image': '/data/mosaic/%s.png' % '-'.join(names),
+                    'width': 1, 'height': 1,
+                    'vms': dict((name, {}) for name in names)}
+            return Paused(info) if names == ['vm-a'] else info
+        model.mosaic_lookup = lookup
+        results = {}
+
+        def get(vms):
+            resp = request(host, port, '/mosaic?vms=%s' % vms)
+            results[vms] = json.loads(resp.read())['vms'].keys()
+        try:
+            t = threading.Thread(target=get, args=('vm-a',))
+            t.start()
+            rendering.wait(5)
+            get('vm-b')
+            finished.set()
+            t.join()
+        finally:
+            del model.mosaic_lookup
+        self.assertEquals({'vm-a': ['vm-a'], 'vm-b': ['vm-b']}, results)
+
+        # Model errors are translated as for any Resource
+        def unavailable(names=None):
+            raise burnet.model.ServiceUnavailable('libvirtd is stalled')
+        model.mosaic_lookup = unavailable
+        try:
+            self.assertHTTPStatus(503, host, port, '/mosaic')
+        finally:
+            del model.mosaic_lookup
+
         # No screenshot after stopped the VM
         request(host, port, '/vms/test-vm/stop', '{}', 'POST')
         resp = request(host, port, '/vms/test-vm/screenshot')
@@ -485,6 +718,47 @@ class RestTests(unittest.TestCase):
             if task['status'] == 'running':
                 time.sleep(1)
 
+    def test_cache_stats(self):
+        stats = json.loads(request(host, port, '/cachestats').read())
+        with model.objstore as session:
+            session.store('template', 'cached', {'name': 'cached'})
+        # A miss fills the cache and the next read hits it
+        with model.objstore as session:
+            for i in xrange(2):
+                session.get('template', 'cached')
+        with model.objstore as session:
+            session.delete('template', 'cached')
+        resp = request(host, port, '/cachestats')
+        self.assertEquals(200, resp.status)
+        new = json.loads(resp.read())
+        self.assertEquals(stats['misses'] + 1, new['misses'])
+        self.assertEquals(stats['hits'] + 1, new['hits'])
+        self.assertEquals(burnet.objectstore.ObjectCache.SIZE, new['size'])
+
+    def test_get_tasks_errors(self):
+        for i in xrange(3):
+            model.add_task('', self._async_op)
+        task_lookup = model.task_lookup
+
+        def lookup(id, wait=0):
+            if id == '1':
+                raise burnet.model.NotFoundError(id)
+            if id == '2' and failing:
+                raise burnet.model.OperationFailed('libvirt error')
+            return task_lookup(id, wait)
+
+        model.task_lookup = lookup
+        try:
+            # A task gone since the listing is left out
+            failing = False
+            tasks = json.loads(request(host, port, '/tasks').read())
+            self.assertEquals(['2', '3'], sorted(t['id'] for t in tasks))
+            # Other errors are not hidden
+            failing = True
+            self.assertHTTPStatus(500, host, port, '/tasks')
+        finally:
+            del model.task_lookup
+
     def test_tasks(self):
         model.add_task('', self._async_op)
         model.add_task('', self._except_op)
@@ -498,3 +772,27 @@ class RestTests(unittest.TestCase):
         foo3 = json.loads(request(host, port, '/tasks/%s' % '3').read())
         self.assertEquals('in progress', foo3['message'])
         self.assertEquals('running', foo3['status'])
+
+        stats = json.loads(request(host, port, '/tasks/stats').read())
+        self.assertEquals(0, stats['queued'])
+
+        # Wait for the end of a task in one request
+        taskid = model.add_task('', self._async_op)
+        task = json.loads(request(host, port,
+                                  '/tasks/%s?wait=5' % taskid).read())
+        self.assertEquals('finished', task['status'])
+        self.assertEquals(None, task['progress'])
+        resp = request(host, port, '/tasks/%s?wait=soon' % taskid)
+        self.assertEquals(400, resp.status)
+
+        taskid = model.add_task('', self._async_op)
+        resp = request(host, port, '/tasks/%s/cancel' % taskid, '{}', 'POST')
+        self.assertEquals(200, resp.status)
+        self._wait_task(taskid)
+        task = json.loads(request(host, port, '/tasks/%s' % taskid).read())
+        self.assertEquals('cancelled', task['status'])
+
+        resp = request(host, port, '/tasks/1/cancel', '{}', 'POST')
+        self.assertEquals(400, resp.status)
+        resp = request(host, port, '/tasks/99/cancel', '{}', 'POST')
+        self.assertEquals(404, resp.status)
@@ -0,0 +1,192 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import io
+import threading
+import time
+import unittest
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+import burnet.model
+import burnet.screenshot
+from burnet.screenshot import ScreenshotScheduler, ThumbnailCache, VMScreenshot
+
+
+class FakeScreenshot(VMScreenshot):
+    color = 'blue'
+
+    def _generate_scratch(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (1024, 768), self.color).save(buf, 'JPEG')
+        return buf.getvalue()
+
+
+class ScreenshotSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.captures = []
+        self.digest = 'a'
+        self.lock = threading.Lock()
+
+    def capture(self, name):
+        if name == 'nosupport':
+            raise burnet.model.NotFoundError('Screenshot not supported')
+        with self.lock:
+            self.captures.append(name)
+            n = len(self.captures)
+        return '/data/screenshots/%s-%i.png' % (name, n), self.digest
+
+    def test_get(self):
+        sched = ScreenshotScheduler(self.capture, workers=2)
+        self.assertEquals('/data/screenshots/vm-1.png', sched.get('vm'))
+        # Later requests read the ready thumbnail without capturing
+        self.assertEquals('/data/screenshots/vm-1.png', sched.get('vm'))
+        self.assertEquals(['vm'], self.captures)
+
+        self.assertRaises(burnet.model.NotFoundError, sched.get, 'nosupport')
+        self.assertRaises(burnet.model.NotFoundError, sched.get, 'nosupport')
+
+    def test_adaptive_interval(self):
+        sched = ScreenshotScheduler(self.capture, workers=2)
+        sched.TICK = 0.05
+        sched.MIN_INTERVAL = 0.1
+        sched.INTERVAL = 0.2
+        sched.get('vm')
+        vm = sched._vms['vm']
+
+        # The screen does not change: capture less often
+        time.sleep(1)
+        self.assertTrue(len(self.captures) > 1)
+        self.assertTrue(vm['interval'] > sched.INTERVAL)
+
+        # Nobody is looking at the VM any more
+        sched.IDLE_SECS = 0
+        time.sleep(0.5)
+        self.assertFalse('vm' in sched._vms)
+        count = len(self.captures)
+        time.sleep(0.5)
+        self.assertEquals(count, len(self.captures))
+
+
+class VMScreenshotTests(unittest.TestCase):
+    def tearDown(self):
+        burnet.screenshot.set_thumbnail_format('png', 75)
+
+    def test_thumbnail_formats(self):
+        for fmt, pil_fmt in (('png', 'PNG'), ('jpeg', 'JPEG')):
+            burnet.screenshot.set_thumbnail_format(fmt, 50)
+            screenshot = FakeScreenshot({'name': 'test'})
+            url, digest = screenshot.capture()
+            name = url.rsplit('/', 1)[-1]
+            self.assertTrue(name.endswith('.' + fmt))
+
+            data, mimetype, mtime, etag = burnet.screenshot.thumbnails.get(name)
+            self.assertEquals('image/' + fmt, mimetype)
+            image = Image.open(io.BytesIO(data))
+            self.assertEquals(pil_fmt, image.format)
+            self.assertEquals((256, 192), image.size)
+
+            screenshot.delete()
+            self.assertRaises(burnet.model.NotFoundError,
+                              burnet.screenshot.thumbnails.get, name)
+
+        self.assertRaises(burnet.model.InvalidParameter,
+                          burnet.screenshot.set_thumbnail_format, 'gif')
+        self.assertRaises(burnet.model.InvalidParameter,
+                          burnet.screenshot.set_thumbnail_format, 'jpeg', 0)
+
+    def test_unchanged_frame(self):
+        screenshot = FakeScreenshot({'name': 'test'})
+        url, digest = screenshot.capture()
+        name = url.rsplit('/', 1)[-1]
+        etag = burnet.screenshot.thumbnails.get(name)[3]
+
+        # Same frame: same thumbnail, URL and entity tag
+        self.assertEquals((url, digest), screenshot.capture())
+        self.assertEquals(etag, burnet.screenshot.thumbnails.get(name)[3])
+
+        screenshot.color = 'red'
+        url2, digest2 = screenshot.capture()
+        self.assertNotEquals(url, url2)
+        self.assertNotEquals(digest, digest2)
+        screenshot.delete()
+
+    def test_thumbnail_cache(self):
+        cache = ThumbnailCache(2)
+        cache.put('a-1.png', 'a', 'A1', 'image/png')
+        cache.put('b-1.png', 'b', 'B1', 'image/png')
+        self.assertEquals('A1', cache.get('a-1.png')[0])
+        # The least recently used superseded thumbnail goes first, the
+        # newest one of each VM stays
+        cache.put('a-2.png', 'a', 'A2', 'image/png')
+        self.assertRaises(burnet.model.NotFoundError, cache.get, 'a-1.png')
+        self.assertEquals('B1', cache.get('b-1.png')[0])
+        cache.put('c-1.png', 'c', 'C1', 'image/png')
+        self.assertEquals(3, len(cache._thumbnails))
+        self.assertEquals(['a', 'b', 'c'], sorted(cache._index))
+        cache.delete('a')
+        self.assertRaises(burnet.model.NotFoundError, cache.get, 'a-2.png')
+        self.assertEquals(['b', 'c'], sorted(cache._index))
+
+    def test_thumbnail_expire(self):
+        cache = ThumbnailCache()
+        cache.put('a-1.png', 'a', 'A1', 'image/png')
+        cache.put('a-2.png', 'a', 'A2', 'image/png')
+        cache.put('b-1.png', 'b', 'B1', 'image/png')
+        cache.expire(60)
+        self.assertEquals('A1', cache.get('a-1.png')[0])
+
+        # The newest thumbnail of each VM is kept
+        cache.expire(-1)
+        self.assertRaises(burnet.model.NotFoundError, cache.get, 'a-1.png')
+        self.assertEquals('A2', cache.get('a-2.png')[0])
+        self.assertEquals('B1', cache.get('b-1.png')[0])
+
+    def test_mosaic(self):
+        urls = {}
+        for name, color in (('vm1', 'blue'), ('vm2', 'red')):
+            screenshot = FakeScreenshot({'name': name})
+            screenshot.color = color
+            urls[name] = screenshot.capture()[0]
+        urls['vm3'] = '/data/screenshots/vm3-gone.png'
+
+        mosaic = burnet.screenshot.get_mosaic(urls)
+        self.assertEquals(['vm1', 'vm2'], sorted(mosaic['vms']))
+        self.assertEquals({'x': 256, 'y': 0, 'width': 256, 'height': 192},
+                          mosaic['vms']['vm2'])
+        self.assertEquals((512, 256), (mosaic['width'], mosaic['height']))
+
+        name = mosaic['image'].rsplit('/', 1)[-1]
+        data = burnet.screenshot.get_thumbnail(name)[0]
+        # Mosaics do not take the room of thumbnails
+        self.assertRaises(burnet.model.NotFoundError,
+                          burnet.screenshot.thumbnails.get, name)
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        self.assertEquals((512, 256), image.size)
+        # Frames are JPEG encoded: compare the dominant channel only
+        r, g, b = image.getpixel((10, 10))
+        self.assertTrue(b > 200 and r < 50)
+        r, g, b = image.getpixel((266, 10))
+        self.assertTrue(r > 200 and b < 50)
+
+        # Same thumbnails, same mosaic
+        self.assertEquals(mosaic, burnet.screenshot.get_mosaic(urls))
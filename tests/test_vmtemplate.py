@@ -51,6 +51,24 @@ class VMTemplateTests(unittest.TestCase):
         expr = "/domain/devices/disk[@device='disk']/target/@dev"
         self.assertEquals('hda', xpath_get_text(xml, expr)[0])
 
+    def test_to_volume_list(self):
+        t = VMTemplate({'name': 'test', 'disks': [
+            {'size': 10},
+            {'size': 20, 'base_path': '/tmp/base.img', 'base_format': 'raw'}]})
+        self.assertTrue(t.has_base())
+        vols = t.to_volume_list('test-vm', '/tmp')
+        self.assertEquals(['test-vm-0.img', 'test-vm-1.img'],
+                          [v['name'] for v in vols])
+        self.assertEquals([], xpath_get_text(vols[0]['xml'],
+                                             "/volume/backingStore/path"))
+        self.assertEquals(['/tmp/base.img'],
+                          xpath_get_text(vols[1]['xml'],
+                                         "/volume/backingStore/path"))
+        self.assertEquals(['raw'],
+                          xpath_get_text(vols[1]['xml'],
+                                         "/volume/backingStore/format/@type"))
+        self.assertFalse(VMTemplate({'name': 'test'}).has_base())
+
     def test_arg_merging(self):
         """
         Make sure that default parameters from osinfo do not override user-
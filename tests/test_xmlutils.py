@@ -0,0 +1,73 @@
+#
+# Project Burnet
+#
+# Copyright IBM, Corp. 2013
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+import burnet.xmlutils
+from burnet.xmlutils import xpath_get_multi, xpath_get_text
+
+XML = """
+<domain type='kvm'>
+  <name>test</name>
+  <devices>
+    <disk device='disk'><source file='/var/lib/a.img'/></disk>
+    <disk device='disk'><source file='/var/lib/b.img'/></disk>
+    <graphics type='vnc' port='5900'/>
+  </devices>
+</domain>
+"""
+
+EXPRS = {'name': '/domain/name',
+         'disks': "/domain/devices/disk[@device='disk']/source/@file",
+         'vnc': "/domain/devices/graphics[@type='vnc']/@port",
+         'missing': '/domain/os/type'}
+
+
+class XmlUtilsTests(unittest.TestCase):
+    def test_get_multi(self):
+        res = xpath_get_multi(XML, EXPRS)
+        self.assertEquals(set(EXPRS), set(res))
+        for name, expr in EXPRS.iteritems():
+            self.assertEquals(xpath_get_text(XML, expr), res[name])
+        self.assertEquals([], res['missing'])
+
+    def test_get_multi_cache(self):
+        parsed = []
+        parseDoc = burnet.xmlutils.libxml2.parseDoc
+
+        def counting_parse(xml):
+            parsed.append(xml)
+            return parseDoc(xml)
+
+        burnet.xmlutils.libxml2.parseDoc = counting_parse
+        try:
+            first = xpath_get_multi(XML, EXPRS, key='uuid-1')
+            first['disks'].append('changed by caller')
+            second = xpath_get_multi(XML, EXPRS, key='uuid-1')
+            self.assertEquals(1, len(parsed))
+            self.assertEquals(['/var/lib/a.img', '/var/lib/b.img'],
+                              second['disks'])
+
+            # A changed document is parsed again
+            xml = XML.replace('5900', '5901')
+            self.assertEquals(['5901'],
+                              xpath_get_multi(xml, EXPRS, key='uuid-1')['vnc'])
+            self.assertEquals(2, len(parsed))
+        finally:
+            burnet.xmlutils.libxml2.parseDoc = parseDoc
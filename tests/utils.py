@@ -99,6 +99,17 @@ def silence_server():
 def running_as_root():
     return os.geteuid() == 0
 
+def remove_objstore(path):
+    """
+    Remove an object store along with its WAL journal files.
+    """
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.unlink(path + suffix)
+        except OSError:
+            pass
+
+
 def request(host, port, path, data=None, method='GET', headers=None):
     if headers is None:
         headers = {'Content-Type': 'application/json',
@@ -70,6 +70,24 @@ var burnet = {
 		});
 	},
 
+	/**
+	 * Get the screenshots of the given running VMs composed into one image.
+	 * The result maps each VM name to the position of its screenshot in
+	 * the image.
+	 */
+	getMosaic : function(vms, suc, err) {
+		$.ajax({
+			url : burnet.url + 'mosaic',
+			type : 'GET',
+			data : { vms : vms },
+			traditional : true,
+			contentType : 'application/json',
+			dataType : 'json',
+			success : suc,
+			error : err
+		});
+	},
+
 	listTemplates : function(suc, err) {
 		$.ajax({
 			url : burnet.url + 'templates',
@@ -115,6 +115,42 @@ burnet.getVmsOldImg = function() {
 	return res;
 }
 
+burnet.getVmTile = function(name) {
+	return $('#guestList').children().filter(function() {
+		return this.id == name;
+	}).find('.tile');
+};
+
+/*
+ * Show the screenshots of running guests from one mosaic image instead of
+ * fetching one image per guest.  Guests missing from the mosaic fall back
+ * to their own screenshot.
+ */
+burnet.showMosaic = function(mosaic, fallback) {
+	var width = 170, height = 110;
+	$.each(mosaic.vms, function(name, pos) {
+		var sx = width / pos.width, sy = height / pos.height;
+		var tile = burnet.getVmTile(name);
+		if (!tile.hasClass('running')) {
+			return;
+		}
+		tile.find('img, .imgmosaic').remove();
+		$('<div class="imgmosaic"></div>').css({
+			'width' : width + 'px',
+			'height' : height + 'px',
+			'background-image' : 'url(' + mosaic.image + ')',
+			'background-size' : mosaic.width * sx + 'px ' +
+			                    mosaic.height * sy + 'px',
+			'background-position' : -pos.x * sx + 'px ' + -pos.y * sy + 'px'
+		}).appendTo(tile);
+	});
+	$.each(fallback, function(name, src) {
+		if (!(name in mosaic.vms)) {
+			burnet.getVmTile(name).find('.imgload').attr('src', src);
+		}
+	});
+};
+
 burnet.listVmsAuto = function() {
 	if(burnet.vmTimeout) {
 		clearTimeout(burnet.vmTimeout);
@@ -124,11 +160,15 @@ burnet.listVmsAuto = function() {
 			var listHtml='';
 			var guestTemplate = burnet.guestTemplate;
 			var oldImages = burnet.getVmsOldImg();
+			var running = [], screenshots = {};
 
 			$.each(result, function(index, value) {
 				var oldImg = oldImages[value.name];
-				curImg = value.state == 'running' ?
-					value.screenshot : value.icon;
+				curImg = value.state == 'running' ? null : value.icon;
+				if (value.state == 'running') {
+					running.push(value.name);
+					screenshots[value.name] = value.screenshot;
+				}
 				value['load-src'] = curImg || 'images/icon-vm.svg';
 				value['tile-src'] = oldImg || value['load-src'];
 				listHtml+=burnet.template(guestTemplate, value);
@@ -140,6 +180,23 @@ burnet.listVmsAuto = function() {
 					$(this).show();
 				}
 			})
+			// The previous mosaic is in the browser cache: show it until
+			// the new one is loaded
+			if (burnet.lastMosaic) {
+				burnet.showMosaic(burnet.lastMosaic, {});
+			}
+			if (running.length) {
+				burnet.getMosaic(running, function(mosaic) {
+					var img = new Image();
+					img.onload = function() {
+						burnet.lastMosaic = mosaic;
+						burnet.showMosaic(mosaic, screenshots);
+					};
+					img.src = mosaic.image;
+				}, function() {
+					burnet.showMosaic({ vms : {} }, screenshots);
+				});
+			}
 			burnet.initVmButtonsAction();
 		}
 	},function() {